@@ -1,15 +1,28 @@
-from os import listdir, remove, path, mkdir
+import os
+from os import environ
 import hashlib
+import heapq
+import asyncio
 import copy
 import json
 import re
+import threading
+import time
 import traceback
 import xml.etree.ElementTree as ET
 
-import requests as http_req
 from flask_cors import CORS
-from flask import Flask, request, jsonify
-from Bio import Entrez
+from flask import Flask, Response, request, jsonify, stream_with_context
+
+from dispatcher import NodeDispatcher
+from entrez_client import EntrezClient
+from entrez_store import EntrezStore
+from genbank_parser import GenBankHeaderParser
+from result_cache import ResultCache
+from sequence_index import SequenceIndex
+from shard_map import ShardMap
+from state_backend import MemoryStateBackend, SQLiteStateBackend
+from tracing import Tracer, traced
 
 # Initializes Flask server and set CORS config
 app = Flask(__name__)
@@ -32,262 +45,301 @@ for db_ip in db_ip_list:
     if db_ip != "\n" and db_ip != "":
         __node_list.append(f"http://{db_ip}/")
 
-# Copies stored database nodes. Will be modified if database
-# nodes go down during run time
+# Maps the database fragments to the nodes holding them. If the shard map file
+# exists, it lists the replicas of each fragment, otherwise every node in
+# DBIPs.txt is its own fragment and searches its default database
+shard_map_path = environ.get("COMM_SHARD_MAP", "./shard_map.json")
+if os.path.exists(shard_map_path):
+    shard_map = ShardMap.from_file(shard_map_path)
+    __node_list = shard_map.nodes
+else:
+    shard_map = ShardMap.from_nodes(__node_list)
+
+# Copies stored database nodes. Rebuilt by the health monitor from
+# the nodes that answered their last status probe
 db_nodes = copy.deepcopy(__node_list)
 
-# Number of database nodes. Used to determine how many
-# responses the server expects to receive
-node_count = len(db_nodes)
-
 # Maximum active processes. Change this based on your computational power
 max_act_prot = 5
 
-# Dict to store results ready to be read
-ready_results = {}
+# Number of best results a query returns unless the plugin asks for another
+# number with ?top_k=N, and the most results a query may ask for
+default_top_k = 10
+max_top_k = 500
+
+# Seconds a query waits for every database partition. Once it passes, the query
+# finishes with the results received so far and lists the partitions missing
+query_deadline = 300
+
+# Where query state is kept. "memory" keeps it in this process. "sqlite" keeps it
+# in the state_db_path file, so the server can run as several worker processes.
+# Active queries of a process that stops, or that are still active twice their
+# deadline after they started, are moved back to the queue by the other processes
+state_backend = environ.get("COMM_STATE_BACKEND", "memory")
+state_db_path = environ.get("COMM_STATE_DB", "./state.db")
+if state_backend == "sqlite":
+    state = SQLiteStateBackend(state_db_path, max_act_prot, query_timeout=2 * query_deadline)
+else:
+    state = MemoryStateBackend(max_act_prot)
+
+# Keeps track of active and pending queries
+qtrack = state.tracker
+
+# Complements of the IUPAC nucleotide codes
+complement_table = str.maketrans("ACGTUNRYKMSWBDHV", "TGCAANYRMKSWVHDB")
+
+# Dict to store results ready to be read, with the time they were ready. Every
+# caller of a query reads the same entry, entries are removed after ready_ttl seconds
+ready_results = state.ready_results
+ready_ttl = 600
+
+# Dict of top results computed before every partition of a query reported
+provisional_results = state.provisional_results
+provisional_lock = threading.Lock()
+# Dict from qid to the pending deadline of each query started by this process
+deadlines = {}
+# Dict from qid to the fragments whose every request failed, for queries started
+# by this process. Such a query finishes as soon as the other fragments reported
+failed_fragments = {}
+failed_lock = threading.Lock()
+
+# Health table of every configured database node. Each entry holds whether the
+# node answered its last status probe, the probe latency, and the node's load
+node_health = state.node_health
+
+# Records timed spans of every query's stages under its qid, served on
+# /debug/trace/<qid>, and their durations as metrics, served on /metrics.
+# Each server process keeps its own traces and metrics
+tracer = Tracer("genbanklink_comm")
+# Time each query started in this process, to measure how long it waits for its fragments
+query_started = {}
+
+# Calls the Entrez E-utilities, limited to NCBI's request rate for the API key
+entrez_client = EntrezClient(api_key=api_key or None, email=email or None,
+                             base_url=environ.get("COMM_EUTILS_URL", "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"),
+                             tracer=tracer)
+
+# Stores metadata fetched from Entrez, refreshed after entrez_ttl seconds
+entrez_store_path = environ.get("COMM_ENTREZ_DB", "./entrez.db")
+entrez_ttl = 30 * 24 * 3600
+entrez_store = EntrezStore(entrez_store_path, ttl=entrez_ttl)
+
+# Stores the top hits of every resolved sequence, so queries for a sequence that
+# was already searched, or for its reverse complement, are answered without BLAST
+sequence_index_path = environ.get("COMM_SEQUENCE_INDEX", "./sequences.db")
+sequence_index = SequenceIndex(sequence_index_path)
+
+# Limits of the result cache: number of results and bytes kept on disk, bytes
+# kept in memory, and seconds before a cached result is fetched again
+cache_max_entries = 1000
+cache_max_bytes = 512 * 2**20
+cache_memory_bytes = 64 * 2**20
+cache_ttl = 7 * 24 * 3600
+
+# Fraction of partitions that must report before the plugin page is shown
+# provisional results, which are updated as the remaining partitions report
+provisional_fraction = 0.5
+
+# Times a fragment's query is resent, preferably to another replica, after its
+# node fails or dies, and the percentile of recent fragment latencies after which
+# a slow fragment is also sent to a second replica. None turns hedging off
+fragment_retries = 2
+hedge_percentile = 0.95
+
+# Seconds between status probes of the database nodes, and how long
+# each probe waits for an answer
+health_interval = 15
+health_timeout = 5
+# Seconds between this process's heartbeats in the shared state, which
+# must be well under the backend's owner_timeout
+heartbeat_interval = 10
+
+# Requests refused by a saturated database node, as (fragment, qid, sequence,
+# node). They are sent again, to the least loaded replica of the fragment, whenever
+# a query finishes and frees capacity, or the health monitor finds the node that
+# refused them no longer busy
+deferred_requests = []
+deferred_lock = threading.Lock()
+
+# Notified whenever a query receives results or finishes, so the bulk workers
+# see finished chunks at once. They also re-check every event_check_interval seconds
+state_changed = threading.Condition()
+event_check_interval = 1
+# Each event stream waits on the condition of its query, notified only when that
+# query changes, as [condition, streams open], by qid. Other server processes
+# cannot notify it, so with the SQLite backend streams re-check every
+# event_check_interval seconds, otherwise every stream_check_interval
+stream_conditions = {}
+stream_lock = threading.Lock()
+stream_check_interval = 15
+# Seconds an event stream stays open before the browser has to reconnect, and
+# the most streams open at once in this process. Each holds a server thread, so
+# pages beyond it are refused and fall back to polling /plugin_poll
+event_stream_timeout = 300
+max_event_streams = 16
+open_streams = threading.BoundedSemaphore(max_event_streams)
+
+# Dict from qid to the sequence and top_k of each query of a bulk request that
+# waits to be searched. Bulk queries are searched bulk_chunk_size at a time, each
+# chunk sent to every fragment in one request so the nodes search its sequences
+# in shared blastn runs, with up to bulk_workers chunks running. Bulk queries do
+# not take the tracker's slots, so page views are not queued behind them
+bulk_queries = state.bulk_queries
+bulk_chunk_size = 16
+bulk_workers = 2
+# Most sequences accepted in one bulk request
+max_bulk_sequences = 5000
+
+
+def index_pubmed_summaries(pubmed_obj):
+    # Turns a list of PubMed article summaries into a dict keyed by PubMed ID
+    return {str(doc.get('Id')): doc for doc in pubmed_obj}
+
+
+def index_nuccore_summaries(nuccore_obj):
+    # Turns a list of GenBank file summaries into a dict keyed by accession, both with
+    # its version and without it, since the database nodes report accessions without
+    # a version. An exact versioned key is never replaced by another version's entry
+    index = {}
+    for doc in nuccore_obj:
+        accession_version = doc.get("AccessionVersion")
+        if accession_version:
+            index[accession_version] = doc
+            index.setdefault(accession_version.split(".")[0], doc)
+    return index
 
 
-def parse_pubmed_summary(pubmed_id, pubmed_obj):
-    # This function searches through a dict of PubMed article summaries and finds the particular
-    # PubMed article with the id pubmed_id. It then parses out the list of Authors
+def parse_pubmed_summary(pubmed_id, pubmed_index):
+    # This function looks up the PubMed article with the id pubmed_id in a dict of PubMed
+    # article summaries keyed by id. It then parses out the list of Authors
     # Journal, Publication Title, Consortium, Date of Publication, DOI, reference count,
     # and Online link (if they exist) and returns this as a dict
 
     data = {}
-    # Loop through each object and check if the id is the inputted id
-    for doc in pubmed_obj:
-        if doc.get('Id') == pubmed_id:
-            consort = ""
-            # Gets Pub title
-            data["Publication Title"] = doc.get('Title')
-            # Gets Author and Consortium, if it exists
-            if doc.get('LastAuthor') == doc.get('AuthorList')[-1]:
-                data["Authors"] = ", ".join(doc.get('AuthorList'))
-            else:
-                data["Authors"] = ", ".join(doc.get('AuthorList')[0:-1])
-                consort = doc.get("AuthorList")[-1]
-            data["Journal"] = doc.get('FullJournalName')
-            if consort:
-                data["Consortium"] = consort
-            # Gets date and converts it from
-            # Year Month Day format to Month Day Year format
-            ymd = doc.get("PubDate")
-            if ymd is not None:
-                mdy = ymd.split()
-                mdy.append(mdy[0])
-                mdy.pop(0)
-                data["Date Published"] = " ".join(mdy)
-            # Gets DOI, ref count, link, and id
-            data["DOI"] = doc.get("DOI")
-            data["Reference Count"] = str(int(doc.get("PmcRefCount")))
-            data["Link"] = f"https://pubmed.ncbi.nlm.nih.gov/{doc.get('Id')}/"
-            data["PubMed ID"] = doc.get("Id")
-            break
+    doc = pubmed_index.get(pubmed_id)
+    if doc is not None:
+        consort = ""
+        # Gets Pub title
+        data["Publication Title"] = doc.get('Title')
+        # Gets Author and Consortium, if it exists
+        author_list = list(doc.get('AuthorList') or [])
+        if not author_list or doc.get('LastAuthor') == author_list[-1]:
+            data["Authors"] = ", ".join(author_list)
+        else:
+            data["Authors"] = ", ".join(author_list[0:-1])
+            consort = author_list[-1]
+        data["Journal"] = doc.get('FullJournalName')
+        if consort:
+            data["Consortium"] = consort
+        # Gets date and converts it from
+        # Year Month Day format to Month Day Year format
+        ymd = doc.get("PubDate")
+        if ymd is not None:
+            mdy = ymd.split()
+            mdy.append(mdy[0])
+            mdy.pop(0)
+            data["Date Published"] = " ".join(mdy)
+        # Gets DOI, ref count, link, and id
+        data["DOI"] = doc.get("DOI")
+        data["Reference Count"] = str(int(doc.get("PmcRefCount")))
+        data["Link"] = f"https://pubmed.ncbi.nlm.nih.gov/{doc.get('Id')}/"
+        data["PubMed ID"] = doc.get("Id")
     # Filters out any entries with no data
     filtered_data = {key: val for key, val in data.items() if val is not None}
     return filtered_data
 
 
-def parse_nuccore_summary(nuccore_id, nuccore_obj):
-    # This function searches through a dict of GenBank file summaries results and finds the particular
-    # GenBank file with the id nuccore_id. It then parses out the definition
+def parse_nuccore_summary(nuccore_id, nuccore_index):
+    # This function looks up the GenBank file with the id nuccore_id in a dict of GenBank
+    # file summaries keyed by accession. It then parses out the definition
     # Locus, sequence length, and online link (if they exist) and returns this as a dict
     data = {}
-    # Loop through each object and check if the id is the inputted id
-    for doc in nuccore_obj:
-        # Since some parts can have different versions, parse only the
-        # ID without the version
-        if nuccore_id.split(".")[0] in doc.get("AccessionVersion"):
-            # Gets the definition
-            data["Definition"] = doc.get("Title")
-            # Gets the Locus
-            data["Locus"] = doc.get("Caption")
-            # Gets the Length
-            data["Length"] = str(int(doc.get("Length")))
-            # Gets the Link
-            data["Link"] = f"https://www.ncbi.nlm.nih.gov/nuccore/{nuccore_id}/"
-            break
+    doc = nuccore_index.get(nuccore_id)
+    if doc is not None:
+        # Gets the definition
+        data["Definition"] = doc.get("Title")
+        # Gets the Locus
+        data["Locus"] = doc.get("Caption")
+        # Gets the Length
+        data["Length"] = str(int(doc.get("Length")))
+        # Gets the Link
+        data["Link"] = f"https://www.ncbi.nlm.nih.gov/nuccore/{nuccore_id}/"
     # Filters out any entries with no data
     filtered_data = {key: val for key, val in data.items() if val is not None}
     return filtered_data
 
 
-def get_full_gb_info(accession_id_list, api_key_string=None):
+def genbank_info(accession_id, record):
+    # Builds the data shown for a GenBank file from its parsed header: the definition,
+    # locus, source, link and one publication entry per titled reference
+    info_dict = {}
+    if record.get("DEFINITION"):
+        info_dict['Definition'] = record["DEFINITION"]
+    if record.get("LOCUS"):
+        info_dict['Locus'] = record["LOCUS"]
+    if record.get("SOURCE"):
+        info_dict['Source'] = record["SOURCE"]
+    info_dict['Link'] = "https://www.ncbi.nlm.nih.gov/nuccore/" + accession_id
+
+    pubdata = []
+    for reference in record["REFERENCES"]:
+        if not reference.get("TITLE"):
+            continue
+        publication = {'Publication Title': reference["TITLE"]}
+        if reference.get("AUTHORS"):
+            publication['Authors'] = reference["AUTHORS"]
+        if reference.get("JOURNAL"):
+            publication['Journal'] = reference["JOURNAL"]
+        if reference.get("CONSRTM"):
+            publication['Consortium'] = reference["CONSRTM"]
+        if reference.get("PUBMED"):
+            publication['Link'] = f"https://pubmed.ncbi.nlm.nih.gov/{reference['PUBMED']}/"
+            publication['PubMed ID'] = reference["PUBMED"]
+        pubdata.append(publication)
+    if pubdata:
+        info_dict['pubdata'] = pubdata
+    return info_dict
+
+
+async def get_full_gb_info(accession_id_list):
     # This function performs a full search of a Genbank file. This is done in the case
     # that a GenBank file does not have any PubMed data assoicated with it. This usually
     # takes much longer than just getting the PubMed and GenBank summaries, so we prefer
     # to get the summaries if they return data.
-    # Accession ID list is a list of accession IDs and api_key_string is the Entrez
-    # api key, if provided
-
-    # Turn accession_id_list into a single string with comma-separated acccession IDs
-    sep = ","
-    accession_ids = sep.join(accession_id_list)
-
-    # Creates URL for GET request
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
-    # Nucleotide DB
-    database_name = "nuccore"
-    # Want GenBank Files as a response
-    rettype = "gb"
-    retmode = "text"
-
-    # Url format for performing a database fetch from Entrez
-    fetch_url = f"efetch.fcgi?db={database_name}&id={accession_ids}&rettype={rettype}&retmode={retmode}"
-
-    # Sets api_key if a key is provided
-    api_key = ""
-    if api_key_string is not None:
-        api_key = f"&api_key={api_key_string}"
-
-    # Calls the Entrez API and stores the response
-    resp = http_req.get(base_url+fetch_url+api_key)
-
-    # Large string of all GenBank files. Each file is separated by "//\n"
-    combined_gb_files = resp.content.decode()
-
-    # Splits into list of strings with file data, removes trailing newline from list
-    gb_file_list = combined_gb_files.split("//\n")
-    if '\n' in gb_file_list:
-        gb_file_list.remove('\n')
-
-    # Initializes variable which will store final results
+    # Accession ID list is a list of accession IDs. Returns a dict of accession ID to its
+    # data, for every accession whose GenBank file was found
+
+    # Parses the header of each GenBank file while the files are fetched from Entrez,
+    # indexing the records by accession with and without version
+    parser = GenBankHeaderParser()
+    records = {}
+    async for line in entrez_client.efetch_lines("nuccore", accession_id_list, rettype="gb"):
+        record = parser.feed(line)
+        if record is not None:
+            for key in (record.get("ACCESSION"), record.get("VERSION"), record.get("LOCUS")):
+                if key:
+                    records.setdefault(key, record)
+
+    # Stores information with accession ID as key
     payload = {}
-
-    # Loops through each GenBank file
-    for i, gb_file in enumerate(gb_file_list):
-
-        # Initializes Dict to format results before being appended into payload
-        info_dict = {}
-
-        locus_str = ""
-        def_str = ""
-        source_str = ""
-        ref_str = ""
-        auth_str = ""
-        cons_str = ""
-        title_str = ""
-        journ_str = ""
-        pubmed_str = ""
-
-        # Generates RegEx patterns to search strings
-        pattern_locus = re.compile(
-            r'(?<=^LOCUS\s{7})([\S]+?)(?=\s+)', re.MULTILINE)
-        pattern_def = re.compile(
-            r'(?<=^DEFINITION\s{2})([\s\S]+?)(?=\n[A-Z]{2,})', re.MULTILINE)
-        pattern_source = re.compile(
-            r'(?<=^SOURCE\s{6})([\s\S]+?)(?=\n\s*[A-Z]{2,})', re.MULTILINE)
-        pattern_ref = re.compile(
-            r'(?<=REFERENCE\s{3})([0-9].*)(?=\n)$', re.MULTILINE)
-        pattern_auth = re.compile(
-            r'(?<=\s{2}AUTHORS\s{3})([\s\S]+?)(?=\s{3}[A-Z]{2,})', re.MULTILINE)
-        pattern_cons = re.compile(
-            r'(?<=\s{2}CONSRTM\s{3})([\s\S]+?)(?=\s{3}[A-Z]{2,})', re.MULTILINE)
-        pattern_title = re.compile(
-            r'(?<=\s{2}TITLE\s{5})([\s\S]+?)(?=\s{3}[A-Z]{2,})', re.MULTILINE)
-        pattern_journ = re.compile(
-            r'(?<=\s{2}JOURNAL\s{3})([\s\S]+?)(?=\n\s{0,4}[A-Z]{2,})', re.MULTILINE)
-        pattern_pubmed = re.compile(
-            r'(?<=PUBMED\s{3})([\w\d]+)(?=\n)$', re.MULTILINE)
-
-        # Searches document with RegEx patters
-        locus_regex = re.search(pattern_locus, gb_file)
-        def_regex = re.search(pattern_def, gb_file)
-        source_regex = re.search(pattern_source, gb_file)
-        ref_regex = re.search(pattern_ref, gb_file)
-        auth_regex = re.search(pattern_auth, gb_file)
-        cons_regex = re.search(pattern_cons, gb_file)
-        title_regex = re.search(pattern_title, gb_file)
-        journ_regex = re.search(pattern_journ, gb_file)
-        pubmed_regex = re.search(pattern_pubmed, gb_file)
-
-        # Constructs dictionary with found parameters, removes trailing spaces
-        if def_regex:
-            def_str = def_regex.group(0).replace("\n           ", "")
-            info_dict['Definition'] = def_str
-
-        if locus_regex:
-            locus_str = locus_regex.group(0).replace("\n           ", "")
-            info_dict['Locus'] = locus_str
-
-        info_dict['Link'] = "https://www.ncbi.nlm.nih.gov/nuccore/" + \
-            accession_id_list[i]
-
-        info_dict['pubdata'] = [{}]
-
-        if title_regex:
-            title_str = title_regex.group(0).replace("\n           ", "")
-            info_dict['pubdata'][0]['Publication Title'] = title_str
-
-        if auth_regex:
-            auth_str = auth_regex.group(0).replace("\n           ", "")
-            info_dict['pubdata'][0]['Authors'] = auth_str
-
-        if journ_regex:
-            journ_str = journ_regex.group(0).replace("\n           ", "")
-            info_dict['pubdata'][0]['Journal'] = journ_str
-
-        if cons_regex:
-            cons_str = cons_regex.group(0).replace("\n           ", "")
-            info_dict['pubdata'][0]['Consortium'] = cons_str
-
-        if pubmed_regex:
-            pubmed_str = pubmed_regex.group(0).replace("\n           ", "")
-            info_dict['pubdata'][0]['Link'] = f"https://pubmed.ncbi.nlm.nih.gov/{pubmed_str}/"
-            info_dict['pubdata'][0]['PubMed ID'] = pubmed_str
-
-        # Stores information with accession ID as key
-        payload[accession_id_list[i]] = info_dict
-
+    for accession_id in accession_id_list:
+        if accession_id in records:
+            payload[accession_id] = genbank_info(accession_id, records[accession_id])
     return payload
 
 
-def get_info_from_accession_ids_elink(results_list, user_email=None, api_key_string=None):
-    # This function takes the results list created from the output of the database nodes,
-    # finds the associated data with each GenBank accession number, and adds it to the results list.
-    # This is done by either getting a summary of the GenBank and PubMed articles, or by searching the
-    # entire GenBank page, depending on if the summaries return data.
-    # results_list is a dict containing all accession numbers to check
-    # user_email is the user's email for Entrez identifying the current user
-    # api_key_string is the string for the api key
-
-    # Stores results list for appending data without making changes if an error occurs
-    payload = copy.deepcopy(results_list)
-    # Gets list of accession IDs
-    accession_id_list = []
-    for doc in payload['results']:
-        accession_id_list.append(doc['accession'])
+async def get_pubmed_links(accession_id_list):
+    # Finds the PubMed IDs linked to each GenBank accession with the Entrez Elink API.
+    # Returns a dict of accession ID to its list of PubMed IDs
 
-    # Turn accession_id_list into a single string with comma-separated acccession IDs
-    sep = ","
-    accession_ids = sep.join(accession_id_list)
-
-    # Sets api_key if a key is provided
-    api_key = ""
-    if api_key_string:
-        Entrez.api_key = api_key_string
-        api_key = f"&api_key={api_key_string}"
-    if user_email:
-        Entrez.email = "anirudhw@bu.edu"
-    accession_id_list = accession_ids.split(",")
-
-    # Sets up the URL parameters for the Entrez Elink API request
-    base_url = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
-    # Original DB is nuccore (GenBank)
-    dbfrom = "nuccore"
-    # Target DB is PubMed
-    db = "pubmed"
-    # Want to find link between GenBank and PubMed data
-    link_name = "nuccore_pubmed"
-    ids = accession_ids.replace(",", "&id=")
-    elink_url = f"elink.fcgi?dbfrom={dbfrom}&db={db}&id={ids}&linkname={link_name}"
-    # Performs GET request to Entrez API and stores the result
-    req = http_req.get(base_url+elink_url+api_key)
+    # Original DB is nuccore (GenBank), target DB is PubMed, and we
+    # want to find the link between GenBank and PubMed data
+    resp = await entrez_client.elink("nuccore", "pubmed", "nuccore_pubmed", accession_id_list)
 
     # List to hold all of the associated PubMed IDs per GenBank file
     pubmed_ids_per_doc = []
 
-    root = ET.fromstring(req.content.decode())
+    root = ET.fromstring(resp.decode())
     link_sets = root.findall('LinkSet')
     for link_set in link_sets:
         pubmed_ids = []
@@ -299,337 +351,786 @@ def get_info_from_accession_ids_elink(results_list, user_email=None, api_key_str
         pubmed_ids_per_doc.append(pubmed_ids)
 
     # Stores the related pubmed ids per genbank id in a dict
-    nuccore_pubmed = dict(zip(accession_id_list, pubmed_ids_per_doc))
-
-    # Gets flat list of all pubmed ids to be searched, then
-    # creates single comma separated string with all IDs
-    pubmed_search_list = [
-        pubmed_id for pubmed_ids in pubmed_ids_per_doc for pubmed_id in pubmed_ids]
-    pubmed_search_str = ",".join(pubmed_search_list)
-
-    # Gets summaries of each pubmed article
-    response = Entrez.esummary(db="pubmed", id=pubmed_search_str)
-    pubmed_data = Entrez.read(response)
-    response.close()
-
-    # List to hold GenBank ids that will be searched via summary
-    summ_search_nuccore_ids = []
-    # List to hold GenBank ids that will be searched via a full search of the
-    # GenBank file (if no PubMed articles found)
-    full_search_nuccore_ids = []
-
-    # For each genbank file with associated pubmed ids, store its assoicated data,
-    # otherwise, mark the genbank file for a full search
-    for nuccore_id in accession_id_list:
-        if nuccore_pubmed[nuccore_id]:
-            summ_search_nuccore_ids.append(nuccore_id)
-            for i, pubmed_id in enumerate(nuccore_pubmed[nuccore_id]):
-                nuccore_pubmed[nuccore_id][i] = parse_pubmed_summary(
-                    pubmed_id, pubmed_data)
-        else:
-            full_search_nuccore_ids.append(nuccore_id)
+    return dict(zip(accession_id_list, pubmed_ids_per_doc))
+
+
+async def fetch_stored(kind, keys, fetch_missing):
+    # Returns the entries of the given kind from the Entrez metadata store. Keys
+    # missing from the store are fetched with the fetch_missing coroutine function,
+    # which returns a dict of the entries it found, and those are stored. The
+    # store is read and written in the loop's executor, off the event loop
+    run = asyncio.get_running_loop().run_in_executor
+    entries = await run(None, entrez_store.get_many, kind, keys)
+    missing = [key for key in dict.fromkeys(keys) if key not in entries]
+    if missing:
+        new_entries = await fetch_missing(missing)
+        await run(None, entrez_store.put_many, kind, new_entries)
+        entries.update(new_entries)
+    return entries
+
+
+async def fetch_pubmed_summaries(pubmed_ids):
+    # Gets the parsed summaries of PubMed articles from Entrez
+    pubmed_index = index_pubmed_summaries(await entrez_client.esummary("pubmed", pubmed_ids))
+    summaries = {}
+    for pubmed_id in pubmed_ids:
+        summary = parse_pubmed_summary(pubmed_id, pubmed_index)
+        if summary:
+            summaries[pubmed_id] = summary
+    return summaries
+
+
+async def fetch_nuccore_summaries(nuccore_ids):
+    # Gets the parsed summaries of GenBank files from Entrez
+    nuccore_index = index_nuccore_summaries(await entrez_client.esummary("nuccore", nuccore_ids))
+    summaries = {}
+    for nuccore_id in nuccore_ids:
+        summary = parse_nuccore_summary(nuccore_id, nuccore_index)
+        if summary:
+            summaries[nuccore_id] = summary
+    return summaries
+
+
+async def get_accession_info(accession_id_list):
+    # Gets the links, summaries and full GenBank data of the given accessions. Calls
+    # that do not depend on each other run concurrently: the GenBank summaries are
+    # fetched while Elink runs, and once the links are known the PubMed summaries and
+    # the full GenBank files of accessions without PubMed links are fetched together.
+    # Returns the links, PubMed summaries, GenBank summaries and full GenBank data
+    accession_ids = list(dict.fromkeys(accession_id_list))
+    known_links = await asyncio.get_running_loop().run_in_executor(
+        None, entrez_store.get_many, "links", accession_ids)
+    info = {}
+
+    async def links_then_details():
+        nuccore_pubmed = await fetch_stored("links", accession_ids, get_pubmed_links)
+        pubmed_ids = [pubmed_id for nuccore_id in accession_ids for pubmed_id in nuccore_pubmed[nuccore_id]]
+        full_search_nuccore_ids = [nuccore_id for nuccore_id in accession_ids if not nuccore_pubmed[nuccore_id]]
+        info["links"] = nuccore_pubmed
+        info["pubmed"], info["genbank"] = await asyncio.gather(
+            fetch_stored("pubmed", pubmed_ids, fetch_pubmed_summaries),
+            fetch_stored("genbank", full_search_nuccore_ids, get_full_gb_info))
+
+    # Summaries are needed for every accession, except those already
+    # known to have no PubMed links
+    summ_search_nuccore_ids = [nuccore_id for nuccore_id in accession_ids
+                               if known_links.get(nuccore_id, True)]
+    info["nuccore"] = (await asyncio.gather(
+        fetch_stored("nuccore", summ_search_nuccore_ids, fetch_nuccore_summaries),
+        links_then_details()))[0]
+    return info
+
+
+def get_info_from_accession_ids_elink(results_list):
+    # This function takes the results list created from the output of the database nodes,
+    # finds the associated data with each GenBank accession number, and adds it to the results list.
+    # This is done by either getting a summary of the GenBank and PubMed articles, or by searching the
+    # entire GenBank page, depending on if the summaries return data. Data found in the Entrez
+    # metadata store is used as is, only missing entries are fetched from NCBI and then stored.
+    # results_list is a dict containing all accession numbers to check
 
-    # If there are GenBank files with associated PubMed articles,
-    # parse and store their relevant data
-    if summ_search_nuccore_ids:
-        response = Entrez.esummary(db="nuccore", id=accession_ids)
-        summ_genbank_data = Entrez.read(response)
-        response.close()
+    # Stores results list for appending data without making changes if an error occurs
+    payload = copy.deepcopy(results_list)
+    # Gets list of accession IDs
+    accession_id_list = []
+    for doc in payload['results']:
+        accession_id_list.append(doc['accession'])
 
-    # If there are GenBank files with no associated PubMed articles,
-    # perform a full search of their GenBank page and store their relevant data
-    if full_search_nuccore_ids:
-        full_genbank_data = get_full_gb_info(
-            full_search_nuccore_ids, api_key_string=api_key_string)
+    # Runs the Entrez calls on the dispatcher's event loop, traced under the query's id
+    info = dispatcher.run(traced(payload['qid'], get_accession_info(accession_id_list)))
 
     # Assembles summary and full search data in payload
     for i, nuccore_id in enumerate(accession_id_list):
         # If the GenBank data was found via summary, store data
         # with PubMed summary
-        if nuccore_id in summ_search_nuccore_ids:
-            nuccore_id_data = parse_nuccore_summary(
-                nuccore_id, summ_genbank_data)
-            nuccore_id_data["pubdata"] = nuccore_pubmed[nuccore_id]
+        if info["links"][nuccore_id]:
+            nuccore_id_data = copy.deepcopy(info["nuccore"].get(nuccore_id, {}))
+            nuccore_id_data["pubdata"] = [info["pubmed"].get(pubmed_id, {})
+                                          for pubmed_id in info["links"][nuccore_id]]
         # If the GenBank data was found via a full search,
         # store data with results from full search
-        elif nuccore_id in full_search_nuccore_ids:
-            nuccore_id_data = full_genbank_data[nuccore_id]
+        else:
+            nuccore_id_data = info["genbank"].get(
+                nuccore_id, {'Link': "https://www.ncbi.nlm.nih.gov/nuccore/" + nuccore_id})
         payload["results"][i]["data"] = nuccore_id_data
 
     return payload
 
 
-def get_top_ten_results(results_list, qid):
-    # This function takes all of the results received from the
-    # database nodes, sorts them by their score (assigned by BLAST),
-    # and, if there are more than 10 returned results, takes only the top 10
+def rank(result):
+    # Orders results by descending score, breaking ties by accession so the
+    # order does not depend on which database node answered first
+    return (-result['score'], result['accession'])
+
 
-    combined_results_list = []
-    # Puts all results in singluar list
-    for result in results_list:
-        combined_results_list.extend(result)
-    # Sorts results by socre
-    sorted_results_list = sorted(
-        combined_results_list, key=lambda res: res['score'], reverse=True)
-    # Trims list if there are more than 10 results
-    if len(sorted_results_list) > 10:
-        sorted_results_list = sorted_results_list[0:10]
+def get_top_results(results_list, qid, top_k):
+    # This function takes the results received from each database node,
+    # which every node sends sorted by rank, and merges them with a heap
+    # until the top_k best distinct accessions are found. An accession found
+    # in several database partitions is only kept with its best score
 
-    return {"qid": qid, "results": sorted_results_list}
+    top_results = []
+    seen = set()
+    for result in heapq.merge(*results_list, key=rank):
+        if result['accession'] in seen:
+            continue
+        seen.add(result['accession'])
+        top_results.append(result)
+        if len(top_results) == top_k:
+            break
+
+    return {"qid": qid, "results": top_results}
 
 
 def cache_data(qid, data):
-    # This function stores up to 100 results in the cache directory,
+    # This function stores processed results in the result cache,
     # identified by their id
-    files = listdir('./cache')
-    # Keeps past 100 results, replace oldest queries
-    if len(files) > 100:
-        oldest_file = min(files, key=os.path.getctime)
-        remove(os.path.abspath(oldest_file))
-    # Writes data to file with id as name
-    with open('./cache/' + qid, 'w') as qfile:
-        json.dump(data, qfile)
-
-
-class QueryTracker:
-    # This class is used to keep track of all requests made to the plugin to process data
-    def __init__(self, max_act_proc):
-        # List to store all requests being actively worked on
-        self.query_process_list = [-1]*max_act_proc
-        # Queue implemented as a list. It stores any processes that are pending if the query
-        # process list is full
-        self.query_process_queue = []
-        # List of lists that store results. Results are stored according to the index of
-        # that query's id in the query process list
-        self.query_process_results = [[] for i in range(max_act_proc)]
-
-    def exists(self, qid, check_list=True, check_queue=True):
-        # Checks if query exists in queue or list
-        if (check_list and (qid in self.query_process_list)) or (check_queue and any(qid == entry['qid'] for entry in self.query_process_queue)):
-            return True
+    result_cache.put(qid, data)
+
+
+def index_hits(qid, data, top_k):
+    # Stores the hits of a query the database nodes searched in the sequence index.
+    # Only called with fresh BLAST results, so an entry answering later queries
+    # still expires after the index's ttl and its sequence is searched again
+    sequence_index.put(qid.split("-")[0], top_k, data["results"])
+
+
+def notify_state_change(*qids):
+    # Wakes the background workers waiting for any change, and the event
+    # streams of the given queries so they push their new state
+    with state_changed:
+        state_changed.notify_all()
+    with stream_lock:
+        conditions = [stream_conditions[qid][0] for qid in qids if qid in stream_conditions]
+    for condition in conditions:
+        with condition:
+            condition.notify_all()
+
+
+def update_health(health_table):
+    # Stores the latest health table and rebuilds the list of active database
+    # nodes, so nodes that recover are admitted again
+    global db_nodes
+    node_health.update(health_table)
+    db_nodes = [db_node for db_node in __node_list if node_health[db_node]["alive"]]
+    # Requests refused while the node was saturated are not left waiting for
+    # another query to finish, which may never happen if they were the only ones
+    retry_deferred([db_node for db_node, entry in health_table.items()
+                    if entry["alive"] and not entry["load"].get("busy")])
+
+
+def defer_query(db_node, fragment, qid, sequence, load):
+    # Called when a saturated node refuses a query. The request is deferred
+    # until a running query finishes or the node is no longer busy
+    # Entries are assigned again so shared backends store the change
+    entry = node_health[db_node]
+    entry["load"] = load
+    node_health[db_node] = entry
+    with deferred_lock:
+        deferred_requests.append((fragment, qid, sequence, db_node))
+
+
+def node_answered(db_node, fragment, qid, received_data):
+    # Called by the dispatcher with the results a node sent back
+    # on the connection its query was sent on
+    process_node_result(qid, fragment, received_data)
+
+
+def fragment_failed(fragment, qid):
+    # Called by the dispatcher when every request for a fragment of a query failed.
+    # Finishes the query, listing the fragment as missing, once no other fragment
+    # is still searching, instead of waiting for its deadline
+    # A query that already finished, e.g. at its deadline, is not tracked again
+    with failed_lock:
+        if not qtrack.exists(qid, check_queue=False):
+            return
+        failed = failed_fragments.setdefault(qid, set())
+        failed.add(fragment)
+        failed_count = len(failed)
+    print("Giving up on " + str(fragment) + " for query " + qid)
+    if (len(qtrack.reported(qid)) + failed_count >= qtrack.expected(qid)
+            and qtrack.mark_processing(qid, force=True)):
+        finish_query(qid)
+
+
+def live_fragments():
+    # Returns how many fragments have a live replica, which is the number
+    # of results a query waits for
+    return len(shard_map.available(node_health))
+
+
+def choose_replica(fragment, tried):
+    # Called by the dispatcher to resend or hedge a fragment's query. Returns the
+    # least loaded live replica not tried yet, as (db_node, database), or None
+    db_node = shard_map.choose(node_health, fragment, exclude=tried)
+    return None if db_node is None else (db_node, shard_map.database(fragment))
+
+
+def node_alive(db_node):
+    # Tells the dispatcher if a node answered its last status probe
+    return node_health[db_node]["alive"]
+
+
+def send_query(qid, sequence, top_k, fragments=None):
+    # Sends a query for every fragment, or only for the given fragments,
+    # to the least loaded live replica of each
+    assigned = shard_map.assign(node_health, fragments)
+    targets = [(db_node, fragment, shard_map.database(fragment)) for fragment, db_node in assigned.items()]
+    dispatcher.send_query(targets, qid, sequence, node_answered, defer_query,
+                          choose_replica, node_alive, top_k=top_k, on_failed=fragment_failed)
+
+
+def retry_deferred(ready_nodes=None):
+    # Sends deferred requests again, skipping queries that are no longer active.
+    # If ready_nodes is given, only the requests refused by those nodes are sent
+    with deferred_lock:
+        retries = []
+        waiting = []
+        for deferred in deferred_requests:
+            (retries if ready_nodes is None or deferred[3] in ready_nodes else waiting).append(deferred)
+        deferred_requests[:] = waiting
+    for fragment, qid, sequence, db_node in retries:
+        if qtrack.exists(qid, check_queue=False):
+            send_query(qid, sequence, qtrack.top_k(qid), fragments=[fragment])
+
+
+def fragment_of(received_data):
+    # Returns the fragment of results a node posted to /node_data. Nodes
+    # searching their default database are found by their id
+    if shard_map.named:
+        return received_data.get('db')
+    for db_node in __node_list:
+        if str(node_health[db_node]["load"].get("nid")) == str(received_data['nid']):
+            return db_node
+    return str(received_data['nid'])
+
+
+def partition_name(fragment):
+    # Returns the name the plugin page shows for a fragment: its database, or
+    # the id of the node holding it, or the node's address if its id is unknown
+    if shard_map.named:
+        return fragment
+    return str(node_health[fragment]["load"].get("nid", fragment))
+
+
+def missing_partitions(qid):
+    # Returns the names of the database fragments that have not sent
+    # results for an active query
+    reported = set(qtrack.reported(qid))
+    return [partition_name(fragment) for fragment in shard_map.fragments if fragment not in reported]
+
+
+def publish_provisional(qid):
+    # Once provisional_fraction of the partitions have reported, makes the top results
+    # found so far available while the others are still searching. Called again as
+    # each late partition reports, so its results are merged in. Provisional hits only
+    # link to their GenBank page, the Entrez data is fetched once in finish_query
+    results_list = qtrack.get_results(qid)
+    expected = qtrack.expected(qid)
+    if not expected or len(results_list) >= expected or len(results_list) < provisional_fraction * expected:
+        return
+    payload = copy.deepcopy(get_top_results(results_list, qid, qtrack.top_k(qid) or default_top_k))
+    for result in payload["results"]:
+        result["data"] = {'Link': "https://www.ncbi.nlm.nih.gov/nuccore/" + result["accession"]}
+    payload["reported"] = len(results_list)
+    payload["expected"] = expected
+    payload["missing"] = missing_partitions(qid)
+    with provisional_lock:
+        # Keeps results computed from more partitions if those were published first
+        current = provisional_results.get(qid)
+        if qtrack.exists(qid, check_queue=False) and (current is None or current["reported"] < payload["reported"]):
+            provisional_results[qid] = payload
+    notify_state_change(qid)
+
+
+def start_query(qid, sequence, top_k):
+    # Sends a query that just became active, and finishes it with the results
+    # received so far if some partitions have not answered after query_deadline seconds
+    deadlines[qid] = dispatcher.call_later(query_deadline, deadline_reached, qid)
+    query_started[qid] = time.monotonic()
+    send_query(qid, sequence, top_k)
+    notify_state_change(qid)
+
+
+def start_batch(entries):
+    # Sends the queries of a bulk chunk that just became active to every fragment,
+    # one request per fragment for all of them, each with its own deadline
+    for entry in entries:
+        deadlines[entry["qid"]] = dispatcher.call_later(query_deadline, deadline_reached, entry["qid"])
+        query_started[entry["qid"]] = time.monotonic()
+    assigned = shard_map.assign(node_health)
+    targets = [(db_node, fragment, shard_map.database(fragment)) for fragment, db_node in assigned.items()]
+    dispatcher.send_batch(targets, {entry["qid"]: (entry["sequence"], entry["top_k"]) for entry in entries},
+                          node_answered, defer_query, choose_replica, node_alive, fragment_failed)
+
+
+def next_bulk_chunk():
+    # Makes up to bulk_chunk_size queries of bulk requests active and returns them.
+    # Queries cached since they were requested are dropped, those whose hits are in
+    # the sequence index are answered at once instead, and those already tracked,
+    # e.g. running for a page view or started by another worker, are left to finish
+    # there. A query leaves bulk_queries only once it is answered or tracked, so
+    # polls always find it
+    chunk = []
+    for qid in list(bulk_queries):
+        entry = bulk_queries.get(qid)
+        if entry is None:
+            continue
+        if result_cache.contains(qid) or qid in ready_results:
+            pass
+        elif answer_from_index(qid, entry["sequence"], entry["top_k"]):
+            notify_state_change(qid)
+        elif qtrack.new(qid, entry["sequence"], live_fragments(), top_k=entry["top_k"], force=True) == 1:
+            chunk.append(dict(entry, qid=qid))
+        bulk_queries.pop(qid, None)
+        if len(chunk) == bulk_chunk_size:
+            break
+    return chunk
+
+
+def bulk_worker():
+    # Searches the queries of bulk requests one chunk at a time, waiting for
+    # each chunk to finish before starting the next
+    while True:
+        try:
+            started = next_bulk_chunk() if db_nodes else []
+            if started:
+                print("Starting bulk chunk of " + str(len(started)) + " queries")
+                start_batch(started)
+                notify_state_change(*(entry["qid"] for entry in started))
+            while started and any(qtrack.exists(entry["qid"], check_queue=False) for entry in started):
+                with state_changed:
+                    state_changed.wait(event_check_interval)
+            if not started:
+                with state_changed:
+                    state_changed.wait(event_check_interval)
+        except Exception:
+            print(traceback.format_exc())
+            time.sleep(event_check_interval)
+
+
+def keep_state():
+    # Tells the other server processes this one is still running its queries, moves
+    # the active queries of processes that are gone back to the queue, and starts
+    # queued queries while there are free slots, e.g. after a restart
+    while True:
+        try:
+            state.heartbeat()
+            reaped = qtrack.reap()
+            if reaped:
+                print("Requeued queries of stopped server processes: " + ", ".join(reaped))
+            new_id = qtrack.insert_proc_from_queue(live_fragments()) if db_nodes else False
+            while new_id:
+                start_query(new_id['qid'], new_id['sequence'], new_id['top_k'])
+                new_id = qtrack.insert_proc_from_queue(live_fragments())
+        except Exception:
+            print(traceback.format_exc())
+        time.sleep(heartbeat_interval)
+
+
+def deadline_reached(qid):
+    if deadlines.pop(qid, None) is not None and qtrack.mark_processing(qid, force=True):
+        print("Deadline reached for " + qid)
+        finish_query(qid)
+
+
+def finish_query(qid):
+    # Gets the GenBank data for the top results of a query marked as processing
+    # and makes it available to the plugin page, then starts the next queued query.
+    # Results missing some partitions list them and are not cached
+    results_list = qtrack.get_results(qid)
+    # Fragments without a live replica when the query started were never searched either
+    missing = missing_partitions(qid)
+    deadline = deadlines.pop(qid, None)
+    if deadline is not None:
+        deadline.cancel()
+    started = query_started.pop(qid, None)
+    if started is not None:
+        # Time from sending the query to having every fragment's results, or the deadline
+        tracer.record("fan_in", time.monotonic() - started, trace_id=qid,
+                      attrs={"fragments": len(results_list), "missing": missing})
+    try:
+        # Gets the top results by score among all results
+        sorted_results = get_top_results(results_list, qid, qtrack.top_k(qid) or default_top_k)
+        # Gets the related GenBank information from the top results
+        with tracer.span("genbank_info", trace_id=qid):
+            data_ready = get_info_from_accession_ids_elink(sorted_results)
+        if missing:
+            data_ready["missing"] = missing
         else:
-            return False
-
-    def queue_len(self):
-        # Returns how many processes are in the queue
-        return len(self.query_process_queue)
-
-    def new(self, qid, sequence):
-        # Returns -1 if duplicate
-        if self.exists(qid):
-            return -1
-        # Returns 1 if stored in active process list
-        for i, ele in enumerate(self.query_process_list):
-            if self.query_process_list[i] == -1:
-                self.query_process_list[i] = qid
-                return 1
-        # Returns 0 if stored in process queue
-        self.query_process_queue.append({"qid": qid, "sequence": sequence})
-        return 0
-
-    def store_results(self, qid, result):
-        # Stores the results in the corresponding location given the qid
-        ind = self.query_process_list.index(qid)
-        self.query_process_results[ind].append(result)
-
-    def all_results_received(self, qid):
-        # Checks if all results were received for a given qid
-        ind = self.query_process_list.index(qid)
-        if len(self.query_process_results[ind]) == node_count:
-            return True
+            # Caches data
+            cache_data(qid, data_ready)
+            index_hits(qid, data_ready, qtrack.top_k(qid) or default_top_k)
+        # Makes the data available to the javascript
+        ready_results[qid] = {"time": time.time(), "payload": data_ready}
+        print("Results ready to be read")
+    except:
+        # In the event of any error, prints traceback and removes
+        # entry from the process list
+        print("An error occured trying to process the request:\n")
+        print(traceback.format_exc())
+    # Removes entry from queue after processing is done. Its failed fragments
+    # are dropped afterwards, so fragment_failed cannot add them back
+    qtrack.delete_entry_from_proc_list(qid)
+    with failed_lock:
+        failed_fragments.pop(qid, None)
+    with provisional_lock:
+        provisional_results.pop(qid, None)
+    notify_state_change(qid)
+    prune_ready_results()
+    # Resend requests refused by saturated nodes now that capacity freed up
+    retry_deferred()
+    # Pop process from queue if there are waiting queries
+    new_id = qtrack.insert_proc_from_queue(live_fragments())
+    if new_id:
+        # Send request to process new query
+        start_query(new_id['qid'], new_id['sequence'], new_id['top_k'])
+
+
+def prune_ready_results():
+    # Removes results that have been ready for longer than ready_ttl seconds
+    oldest = time.time() - ready_ttl
+    for qid in list(ready_results):
+        entry = ready_results.get(qid)
+        if entry is not None and entry["time"] < oldest:
+            ready_results.pop(qid, None)
+
+
+def normalize_sequence(fasta):
+    # Returns the sequences of a FASTA file without their headers, with whitespace
+    # removed and in upper case, so renderings of the same sequences compare equal.
+    # Records are separated by ">"
+    records = []
+    for line in fasta.splitlines():
+        if line.startswith(">"):
+            records.append([])
+        else:
+            if not records:
+                records.append([])
+            records[-1].append("".join(line.split()).upper())
+    return ">".join("".join(record) for record in records)
+
+
+def reverse_complement(sequence):
+    # Returns the reverse complement of a normalized sequence
+    return sequence.translate(complement_table)[::-1]
+
+
+# Form of the ids made by query_id, the only ones accepted from clients
+qid_pattern = re.compile(r"[0-9a-f]{32}(-[0-9]+)?")
+
+
+def query_id(fasta, top_k):
+    # Returns the id of a query: the md5 hash of its normalized sequence. Queries
+    # for another number of results than the default have their own id
+    qid = hashlib.md5(normalize_sequence(fasta).encode()).hexdigest()
+    if top_k != default_top_k:
+        qid = f"{qid}-{top_k}"
+    return qid
+
+
+def answer_from_index(qid, fasta, top_k):
+    # Looks up the hits of a sequence, or of its reverse complement since blastn
+    # searches both strands, in the sequence index. If they are known, the results
+    # are processed as if the database nodes had found them and True is returned
+    sequence = normalize_sequence(fasta)
+    keys = [hashlib.md5(sequence.encode()).hexdigest(),
+            hashlib.md5(reverse_complement(sequence).encode()).hexdigest()]
+    hits = sequence_index.get(keys, top_k)
+    tracer.count("cache", trace_id=qid, cache="sequence_index", outcome="miss" if hits is None else "hit")
+    if hits is None:
+        return False
+    try:
+        with tracer.span("genbank_info", trace_id=qid):
+            data_ready = get_info_from_accession_ids_elink({"qid": qid, "results": hits})
+        cache_data(qid, data_ready)
+        ready_results[qid] = {"time": time.time(), "payload": data_ready}
+    except:
+        print("An error occured trying to answer the request from the sequence index:\n")
+        print(traceback.format_exc())
         return False
+    return True
 
-    def get_results(self, qid):
-        # Returns the results for a given qid
-        ind = self.query_process_list.index(qid)
-        results = copy.deepcopy(self.query_process_results[ind])
-        return results
-
-    def delete_entry_from_proc_list(self, qid):
-        # Deletes process and results from query_process_list if it exists
-        if(qid in self.query_process_list):
-            ind = self.query_process_list.index(qid)
-            self.query_process_list[ind] = -1
-            self.query_process_results[ind] = []
-            return True
-        else:
-            return False
-
-    def status(self, qid):
-        # Returns the status of a given request
-        # -2 means the process does not exist
-        # -1 means the process is in the queue
-        # A positive, non-zero integer means how many
-        # requests have been received from the db nodes
-        if not self.exists(qid):
-            return -2
-        print(self.query_process_list)
-        if qid in self.query_process_list:
-            ind = self.query_process_list.index(qid)
-            print(ind)
-            return len(self.query_process_results[ind])
-        for item in self.query_process_queue:
-            if qid in item['qid']:
-                return -1
-        return -2
-
-    def insert_proc_from_queue(self):
-        # Moves a process from the queue into the list of active processes
-        if self.queue_len() == 0:
-            return False
-        for i, ele in enumerate(self.query_process_list):
-            if self.query_process_list[i] == -1:
-                popped_data = self.query_process_queue.pop(0)
-                self.query_process_list[i] = popped_data['qid']
-                return popped_data
+
+def process_node_result(qid, fragment, received_data):
+    # Stores the results a database node found in one fragment for a query. Once
+    # results are received for all fragments, the GenBank data for the top
+    # results is retrieved. Returns False if the query is not active
+    if not qtrack.exists(qid, check_queue=False):
         return False
+    node_id = received_data['nid']
+    if 'error' in received_data:
+        # The node's search failed, its empty results are not an answer
+        print("Search of " + str(fragment) + " failed on " + str(node_id) + ": " + str(received_data['error']))
+        fragment_failed(fragment, qid)
+        return True
+    print("Received results for " + str(fragment) + " from " + str(node_id))
+    results = received_data['results']
+    # Adds the spans the node timed, e.g. its queue wait and blastn run, to the trace
+    for span in received_data.get('spans', []):
+        tracer.record("node_" + span['name'], span['duration'], trace_id=qid,
+                      attrs={"node": str(node_id)}, fragment=fragment)
+    # Results sent twice for a fragment are only counted once
+    if not qtrack.store_results(qid, fragment, results):
+        return True
+    notify_state_change(qid)
+    # If all results are received, process the results
+    if qtrack.mark_processing(qid):
+        finish_query(qid)
+    else:
+        try:
+            publish_provisional(qid)
+        except:
+            print("An error occured trying to publish provisional results:\n")
+            print(traceback.format_exc())
+    return True
+
 
+# Sends queries to the database nodes over pooled keep-alive connections. Failed
+# fragment requests are resent and slow ones hedged on another replica
+dispatcher = NodeDispatcher(retries=fragment_retries, hedge_percentile=hedge_percentile, tracer=tracer)
+# Probes the database nodes in the background and keeps node_health current
+dispatcher.start_health_monitor(shard_map.nodes, health_interval, health_timeout, update_health)
 
-# Initializes the query tracker
-qtrack = QueryTracker(max_act_prot)
-# Makes the cache directory if it doesn't already exist
-if not path.isdir('./cache'):
-    mkdir('./cache')
+# Caches processed results in memory and in the cache directory
+result_cache = ResultCache('./cache', max_entries=cache_max_entries, max_bytes=cache_max_bytes,
+                           memory_bytes=cache_memory_bytes, ttl=cache_ttl)
+
+# Keeps this process's heartbeat and the shared query state current
+threading.Thread(target=keep_state, daemon=True).start()
+# Searches the queries of bulk requests in the background
+for _ in range(bulk_workers):
+    threading.Thread(target=bulk_worker, daemon=True).start()
 
 
 @app.route('/status')
 def index():
     print("Got status")
-    return jsonify({"status": 'The server is running'}), 200
+    return jsonify({"status": 'The server is running',
+                    "active": qtrack.active_len(),
+                    "queued": qtrack.queue_len(),
+                    "cache": result_cache.stats(),
+                    "entrez_store": entrez_store.stats(),
+                    "sequence_index": sequence_index.stats(),
+                    "nodes": dict(node_health)}), 200
+
+
+@app.route('/metrics')
+def metrics():
+    # Span durations and event counts in the Prometheus text format
+    return Response(tracer.prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/debug/trace/<qid>')
+def debug_trace(qid):
+    # Timed spans of a query recorded by this server process
+    spans = tracer.trace(qid)
+    if spans is None:
+        return jsonify({"qid": qid, "status": "No trace for this query"}), 404
+    return jsonify({"qid": qid, "spans": spans}), 200
 
 
 @app.route('/plugin_request', methods=['GET', 'POST'])
 def plugin_request():
     # Endpoint for Plugin server to send FASTA file. Sends back
-    # the query id if successful
+    # the query id if successful. ?top_k=N asks for the N best results.
+    # Requests for a sequence that is already cached, running or queued
+    # get the id of that query instead of starting another search
     if request.method == 'POST':
         # Get the data being sent from the plugin
         sequence = request.data.decode('UTF-8')
-        # Store sequence as a md5 hash
-        seq_hash = hashlib.md5(sequence.encode()).hexdigest()
-        # Check if query in cache
-        if seq_hash in listdir('./cache'):
+        top_k = min(max(request.args.get('top_k', default_top_k, type=int), 1), max_top_k)
+        # Store the normalized sequence as a md5 hash
+        seq_hash = query_id(sequence, top_k)
+        # Traces the plugin server's request under the query's id
+        tracer.count("plugin_request", trace_id=seq_hash,
+                     attrs={"plugin_trace": request.headers.get("X-Trace-Id")})
+        # Check if query in cache or its results were just made ready
+        cached = result_cache.contains(seq_hash) or seq_hash in ready_results
+        tracer.count("cache", trace_id=seq_hash, cache="result", outcome="hit" if cached else "miss")
+        if cached:
             return jsonify({"status": "success", "qid": seq_hash}), 200
-        # Checks if any database node cannot be reached
-        # If not, the node's IP address is removed from the list of database
-        # nodes
-        for db_node in db_nodes:
-            try:
-                response = http_req.get(db_node+"status", timeout=10)
-            except (http_req.ReadTimeout, http_req.ConnectionError):
-                db_nodes.remove(db_node)
-                continue
-        # If no database nodes are left in the list, return that the db nodes
-        # are not active
+        # Check if the sequence's hits are already known
+        if answer_from_index(seq_hash, sequence, top_k):
+            print("Answered query from the sequence index "+seq_hash)
+            return jsonify({"status": "success", "qid": seq_hash}), 200
+        # If no database node answered its last status probe, return that
+        # the db nodes are not active
         if not db_nodes:
             return jsonify({"status": "No database nodes active"}), 500
 
-    # Recalculates count of database servers in case some are inactive
-    node_count = len(db_nodes)
-
     print("Got query from plugin "+seq_hash)
 
-    # Add sequence hash to query tracker (aka query id or qid)
-    status = qtrack.new(seq_hash, sequence)
-    # Check if duplicate request
+    # Add sequence hash to query tracker (aka query id or qid). While every live
+    # replica of a fragment is saturated, new queries wait in the queue for running
+    # ones to finish. Replicas are assigned by load, so a busy one means all are busy
+    busy = any(node_health[db_node]["load"].get('busy') for db_node in shard_map.assign(node_health).values())
+    status = qtrack.new(seq_hash, sequence, live_fragments(),
+                        hold=busy and qtrack.active_len() > 0, top_k=top_k)
+    # Check if duplicate request, which waits for the query already running or queued
     if(status == -1):
-        return jsonify({"status": "Error: Duplicate Request"}), 260
+        print("Attached to running query "+seq_hash)
+        code = 250 if qtrack.status(seq_hash) == -1 else 200
+        return jsonify({"status": "success", "qid": seq_hash}), code
     # Check if request enqueued
     if(status == 0):
         return jsonify({"status": "success", "qid": seq_hash}), 250
     # Check if request stored in active process list
     if(status == 1):
-        for db_node in db_nodes:
-            print("Sending to "+db_node)
-            url_post = db_node+"api/request/"+seq_hash
-            header = {'Content-Type': 'text/plain'}
-            response = http_req.post(url_post, sequence, headers=header)
+        start_query(seq_hash, sequence, top_k)
         return jsonify({"status": "success", "qid": seq_hash}), 200
 
 
+@app.route('/plugin_request_batch', methods=['POST'])
+def plugin_request_batch():
+    # Endpoint for the Plugin server to send the FASTA files of many components at
+    # once, as JSON {"sequences": [{"id": ..., "fasta": ...}, ...]}. ?top_k=N asks for
+    # the N best results of each. Sends back the query id of every sequence, in order.
+    # Sequences not cached, running or queued are searched in chunks in the
+    # background, and their results polled with /plugin_poll_batch
+    sequences = (request.get_json(force=True, silent=True) or {}).get("sequences")
+    if (not isinstance(sequences, list) or len(sequences) > max_bulk_sequences
+            or not all(isinstance(item, dict) and isinstance(item.get("fasta"), str) for item in sequences)):
+        return jsonify({"status": f"Expected a list of up to {max_bulk_sequences} sequences"
+                                  " with a FASTA string each"}), 400
+    top_k = min(max(request.args.get('top_k', default_top_k, type=int), 1), max_top_k)
+    if not db_nodes:
+        return jsonify({"status": "No database nodes active"}), 500
+    queries = []
+    added = 0
+    for item in sequences:
+        fasta = item["fasta"]
+        seq_hash = query_id(fasta, top_k)
+        queries.append({"id": item.get("id"), "qid": seq_hash})
+        tracer.count("plugin_request", trace_id=seq_hash, attrs={"bulk": True})
+        # Check if query in cache or its results were just made ready
+        cached = result_cache.contains(seq_hash) or seq_hash in ready_results
+        tracer.count("cache", trace_id=seq_hash, cache="result", outcome="hit" if cached else "miss")
+        if cached or qtrack.exists(seq_hash) or seq_hash in bulk_queries:
+            continue
+        bulk_queries[seq_hash] = {"sequence": fasta, "top_k": top_k}
+        added += 1
+    print(f"Got bulk request from plugin for {len(sequences)} sequences, {added} to search")
+    notify_state_change()
+    return jsonify({"status": "success", "queries": queries}), 200
+
+
+@app.route('/plugin_poll_batch', methods=['POST'])
+def plugin_poll_batch():
+    # Endpoint for the Plugin server to check on many queries at once, sent as
+    # JSON {"qids": [...]}. Sends back the state of each, with its results once done
+    qids = (request.get_json(force=True, silent=True) or {}).get("qids") or []
+    if not isinstance(qids, list) or not all(isinstance(qid, str) and qid_pattern.fullmatch(qid) for qid in qids):
+        return jsonify({"status": "Expected a list of query ids"}), 400
+    return jsonify({"states": {qid: poll_state(qid)[0] for qid in dict.fromkeys(qids)}}), 200
+
+
 @app.route('/node_data/<qid>', methods=['GET', 'POST'])
 def node_data(qid):
-    # Endpoint for the database servers to send the found GenBank IDs.
-    # Once results received from all db servers, the GenBank data
-    # for the top ten results is retrieved
-
-    if request.method == 'POST' and qtrack.exists(qid, check_queue=False):
-        # Stores results from database node
-        seq_hash = qid
-        received_data = request.get_json()
-        node_id = received_data['nid']
-        print("Received results from " + str(node_id))
-        results = received_data['results']
-        qtrack.store_results(seq_hash, results)
-        # If all results are received, process the results
-        if qtrack.all_results_received(qid):
-            results_list = qtrack.get_results(qid)
-            try:
-                # Gets the top ten results by score among all results
-                sorted_results = get_top_ten_results(results_list, qid)
-                # Gets the related GenBank information from the top ten results
-                data_ready = get_info_from_accession_ids_elink(
-                    sorted_results, user_email=email, api_key_string=api_key)
-                # Makes the data available to the javascript
-                ready_results[qid] = data_ready
-                # Caches data
-                cache_data(qid, data_ready)
-                # Removes entry from queue after processing is done
-                qtrack.delete_entry_from_proc_list(qid)
-                print("Results ready to be read")
-            except:
-                # In the event of any error, prints traceback and removes
-                # entry from the process list
-                print("An error occured trying to process the request:\n")
-                print(traceback.format_exc())
-                qtrack.delete_entry_from_proc_list(qid)
-            # Pop process from queue if there are waiting queries
-            new_id = qtrack.insert_proc_from_queue()
-            if new_id:
-                # Send request to process new query
-                for db_node in db_nodes:
-                    url_post = db_node+"api/request/"+new_id['qid']
-                    header = {'Content-Type': 'text/plain'}
-                    response = http_req.post(
-                        url_post, new_id['sequence'], headers=header)
-
-            return jsonify({"status": "sent"}), 200
-        else:
+    # Endpoint for database servers that send their found GenBank IDs
+    # back on a new connection instead of answering the query request
+
+    received_data = request.get_json() if request.method == 'POST' else None
+    if received_data is not None and process_node_result(qid, fragment_of(received_data), received_data):
+        if qtrack.exists(qid, check_queue=False):
             return jsonify({"status": "waiting"}), 250
+        return jsonify({"status": "sent"}), 200
     else:
         return jsonify({"status": "Bad call to node data"}), 400
 
 
-@app.route('/plugin_poll/<qid>')
-def plugin_poll(qid):
+def poll_state(qid):
     # Checks if processed results ready, if so, return genbank data with query number,
-    # otherwise, return just query number and number of nodes waiting to hear back
-
-    # If file is in the cache, return it
-    if qid in listdir('./cache'):
-        with open('./cache/'+qid) as qfile:
-            jdata = json.load(qfile)
+    # otherwise, return just query number and number of nodes waiting to hear back.
+    # Returns the payload and its status code
+    if not isinstance(qid, str) or not qid_pattern.fullmatch(qid):
+        return {"State": "Invalid query id"}, 400
+
+    # If results are in the cache, return them
+    jdata = result_cache.get(qid)
+    if jdata is not None:
         jdata["State"] = "Done"
-        return jsonify(jdata), 200
+        return jdata, 200
     # If the file is ready to be read, respond to the
     # javascript file with the results
-    if qid in ready_results:
-        payload = ready_results.pop(qid)
+    entry = ready_results.get(qid)
+    if entry is not None:
+        payload = entry["payload"]
         payload["State"] = "Done"
-        # Check if needs to be turned into string
-        print(payload)
-        return jsonify(payload), 200
+        return payload, 200
     # Otherwise, print the status of the provided query id
     else:
         status = qtrack.status(qid)
+        if status == -2 and qid in bulk_queries:
+            return {"State": "Query still in queue"}, 250
         if status == -2:
-            return jsonify({"State": "Query not found"}), 220
+            return {"State": "Query not found"}, 220
         elif status == -1:
-            return jsonify({"State": "Query still in queue"}), 250
-        elif status >= 0 and status < node_count:
-            return jsonify({"State": f"{status} out of {node_count} BLAST processes finished"}), 250
-        elif status == node_count:
-            return jsonify({"State": "Retrieving GenBank Files ..."}), 250
+            return {"State": "Query still in queue"}, 250
+        node_count = qtrack.expected(qid)
+        if status >= 0 and status < node_count:
+            # Shows the results found so far once enough partitions reported
+            payload = provisional_results.get(qid)
+            if payload is not None:
+                payload["State"] = f"Provisional results, {payload['reported']} out of {node_count} BLAST processes finished"
+                return payload, 250
+            return {"State": f"{status} out of {node_count} BLAST processes finished"}, 250
+        else:
+            return {"State": "Retrieving GenBank Files ..."}, 250
+
+
+@app.route('/plugin_poll/<qid>')
+def plugin_poll(qid):
+    # Endpoint for the plugin page to check on a query
+    payload, code = poll_state(qid)
+    return jsonify(payload), code
+
+
+@app.route('/plugin_events/<qid>')
+def plugin_events(qid):
+    # Server-Sent Events stream for the plugin page. Pushes the query's state
+    # each time it changes and the results as soon as they are ready, then closes.
+    # Refused with a 503 while max_event_streams are open, the page then polls
+    if not qid_pattern.fullmatch(qid):
+        return jsonify({"State": "Invalid query id"}), 400
+    if not open_streams.acquire(blocking=False):
+        return jsonify({"State": "Too many open event streams, poll /plugin_poll"}), 503
+    with stream_lock:
+        entry = stream_conditions.setdefault(qid, [threading.Condition(), 0])
+        entry[1] += 1
+    condition = entry[0]
+
+    def close():
+        with stream_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                stream_conditions.pop(qid, None)
+        open_streams.release()
+
+    def stream():
+        last_state = None
+        last_sent = time.monotonic()
+        deadline = last_sent + event_stream_timeout
+        while time.monotonic() < deadline:
+            payload, code = poll_state(qid)
+            if payload["State"] != last_state:
+                last_state = payload["State"]
+                last_sent = time.monotonic()
+                yield f"data: {json.dumps(payload)}\n\n"
+            elif time.monotonic() - last_sent > 15:
+                # Comment line that keeps proxies from closing an idle stream
+                last_sent = time.monotonic()
+                yield ": keep-alive\n\n"
+            if code != 250:
+                return
+            with condition:
+                condition.wait(stream_check_interval if state_backend != "sqlite" else event_check_interval)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    response = Response(stream_with_context(stream()), mimetype="text/event-stream", headers=headers)
+    # Runs when the stream ends or the browser goes away
+    response.call_on_close(close)
+    return response
 
 
 if __name__ == '__main__':
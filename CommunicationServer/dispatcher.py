@@ -0,0 +1,300 @@
+import asyncio
+import json
+import time
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+
+class NodeDispatcher:
+    # This class sends queries to the database nodes from an asyncio event loop running
+    # in a background thread. All requests share one aiohttp session, so connections to
+    # each node are pooled and kept alive between queries. Nodes answer a query on the
+    # same connection it was sent on once their BLAST search finishes
+    def __init__(self, node_timeout=660, connections_per_node=32, retries=2, retry_delay=2,
+                 hedge_percentile=0.95, hedge_min_samples=20, check_interval=5, tracer=None,
+                 callback_workers=32):
+        # Seconds to wait for a node to answer a query. Must be longer than the
+        # BLAST timeout on the nodes
+        self.node_timeout = node_timeout
+        self.connections_per_node = connections_per_node
+        # Times a fragment's query is sent again after its request fails, and the
+        # seconds to wait, times the attempt number, before resending to the same node
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # Percentile of recent fragment latencies after which a second replica is
+        # asked as well, None to never hedge, and how many latencies must be known
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=200)
+        # Seconds between checks that the nodes a query waits on are still alive
+        self.check_interval = check_interval
+        # Records the time each fragment takes, traced under the query's id
+        self.tracer = tracer
+        # Threads running the callbacks, which may block and even wait on the loop
+        # with run(). They have their own pool so they never take the threads of the
+        # loop's default executor, which coroutines use for blocking I/O
+        self.callbacks = ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix="dispatcher-callback")
+        self.loop = asyncio.new_event_loop()
+        self.session = None
+        self.thread = threading.Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        self.run(self._open_session())
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _open_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=0, limit_per_host=self.connections_per_node, keepalive_timeout=120)
+        self.session = aiohttp.ClientSession(connector=connector)
+
+    def run(self, coro, timeout=None):
+        # Runs a coroutine on the dispatcher loop and waits for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def submit(self, coro):
+        # Schedules a coroutine on the dispatcher loop without waiting for it
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _callback(self, callback, *args):
+        # Runs a blocking callback in the callback pool, returns an awaitable of its result
+        return self.loop.run_in_executor(self.callbacks, callback, *args)
+
+    async def _call_later(self, delay, callback, args):
+        await asyncio.sleep(delay)
+        await self._callback(callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        # Calls callback(*args) in the callback pool after delay seconds.
+        # Returns a future whose cancel() drops the call
+        return self.submit(self._call_later(delay, callback, args))
+
+    async def _post_query(self, db_node, database, qid, sequence, top_k):
+        # Sends a query for one fragment to one node. Returns ("ok", results) when the
+        # node answers, ("busy", load) when it refuses the query, or ("failed", None)
+        url_post = db_node+"api/request/"+qid
+        # The query id is the trace id the node records its spans under
+        header = {'Content-Type': 'text/plain', 'X-Trace-Id': qid}
+        params = {"wait": "1"}
+        if top_k is not None:
+            params["top_k"] = str(top_k)
+        if database is not None:
+            params["db"] = database
+        timeout = aiohttp.ClientTimeout(total=self.node_timeout)
+        try:
+            async with self.session.post(url_post, data=sequence.encode(), headers=header,
+                                         params=params, timeout=timeout) as response:
+                if response.status == 503:
+                    return "busy", await response.json(content_type=None)
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+                # A node whose search failed answers with an error instead of hits
+                if "error" in data:
+                    raise ValueError(data["error"])
+                return "ok", data
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            print("Query " + qid + " failed on " + db_node)
+            print(traceback.format_exc())
+            return "failed", None
+
+    def hedge_delay(self):
+        # Returns how long a fragment may take before a hedged request is sent to
+        # another replica: the hedge_percentile of the latest fragment latencies.
+        # None while hedging is off or too few latencies are known
+        if self.hedge_percentile is None or len(self.latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile))]
+
+    async def _query_fragment(self, db_node, fragment, database, qid, sequence, top_k,
+                              on_result, on_busy, choose, is_alive, on_failed=None):
+        # Searches one fragment of a query, starting on db_node. A request that fails,
+        # or is sent to a node the health monitor finds dead, is sent again to another
+        # replica, up to retries times. A fragment slower than hedge_delay() is also
+        # sent to a second replica, and the first answer wins. on_failed is called if
+        # every attempt failed. Callbacks run in the callback pool since they may block
+        start = self.loop.time()
+        hedge_after = self.hedge_delay()
+        hedged = hedge_after is None
+        tried = [db_node]
+        retries = 0
+        refused = None
+        attempts = {asyncio.ensure_future(self._post_query(db_node, database, qid, sequence, top_k)): db_node}
+        try:
+            while attempts:
+                wait = self.check_interval
+                if not hedged:
+                    wait = min(wait, max(0, start + hedge_after - self.loop.time()))
+                done, _ = await asyncio.wait(attempts, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+                lost = None
+                for task in done:
+                    node = attempts.pop(task)
+                    status, data = task.result()
+                    if status == "ok":
+                        self.latencies.append(self.loop.time() - start)
+                        if self.tracer is not None:
+                            self.tracer.record("fragment", self.loop.time() - start, trace_id=qid,
+                                               attrs={"node": node, "attempts": len(tried)},
+                                               fragment=fragment)
+                        await self._callback(on_result, node, fragment, qid, data)
+                        return
+                    if status == "busy":
+                        refused = (node, data)
+                    lost = status
+                # Gives up on requests to nodes that stopped answering status probes
+                for task, node in list(attempts.items()):
+                    if not await self._callback(is_alive, node):
+                        print("Query " + qid + " lost " + node)
+                        task.cancel()
+                        del attempts[task]
+                        lost = "failed"
+                if lost and not attempts and retries < self.retries:
+                    # Prefers a replica not tried yet. A failed request may be sent
+                    # to the same node again, a refused one waits to be deferred
+                    replica = await self._callback(choose, fragment, tried)
+                    if replica is None and lost == "failed":
+                        await asyncio.sleep(self.retry_delay * (retries + 1))
+                        replica = await self._callback(choose, fragment, [])
+                    if replica is not None:
+                        retries += 1
+                        refused = None
+                        print("Resending query " + qid + " for " + str(fragment) + " to " + replica[0])
+                        if self.tracer is not None:
+                            self.tracer.count("fragment_resent", trace_id=qid, fragment=fragment)
+                        tried.append(replica[0])
+                        attempts[asyncio.ensure_future(
+                            self._post_query(replica[0], replica[1], qid, sequence, top_k))] = replica[0]
+                elif not hedged and attempts and self.loop.time() - start >= hedge_after:
+                    hedged = True
+                    replica = await self._callback(choose, fragment, tried)
+                    if replica is not None:
+                        print("Hedging query " + qid + " for " + str(fragment) + " on " + replica[0])
+                        if self.tracer is not None:
+                            self.tracer.count("fragment_hedged", trace_id=qid, fragment=fragment)
+                        tried.append(replica[0])
+                        attempts[asyncio.ensure_future(
+                            self._post_query(replica[0], replica[1], qid, sequence, top_k))] = replica[0]
+            if refused is not None:
+                await self._callback(on_busy, refused[0], fragment, qid, sequence, refused[1])
+            elif on_failed is not None:
+                await self._callback(on_failed, fragment, qid)
+        finally:
+            for task in attempts:
+                task.cancel()
+
+    def send_query(self, targets, qid, sequence, on_result, on_busy, choose, is_alive, top_k=None,
+                   on_failed=None):
+        # Sends a query to all targets concurrently and returns immediately. Each
+        # target is a (db_node, fragment, database) tuple, database being the name
+        # the node searches or None for its default database.
+        # on_result(db_node, fragment, qid, data) is called as each fragment is answered,
+        # on_busy(db_node, fragment, qid, sequence, load) when a fragment's query is refused
+        # and no other replica took it, choose(fragment, tried) returns another replica as
+        # (db_node, database), preferring those not in tried, or None, and is_alive(db_node)
+        # tells if a node still answers status probes. on_failed(fragment, qid) is called
+        # when every request for a fragment failed.
+        # top_k is the number of best hits each node returns, the node's default if None
+        for db_node, fragment, database in targets:
+            print("Sending to "+db_node)
+            self.submit(self._query_fragment(db_node, fragment, database, qid, sequence, top_k,
+                                             on_result, on_busy, choose, is_alive, on_failed))
+
+    async def _post_batch(self, db_node, database, queries):
+        # Sends several queries for one fragment to one node in one request, so the
+        # node searches them together. Returns like _post_query, the node's answer
+        # listing the results of each query and the queries it refused
+        url_post = db_node+"api/batch"
+        params = {"db": database} if database is not None else {}
+        body = {"queries": [{"qid": qid, "sequence": sequence, "top_k": top_k}
+                            for qid, (sequence, top_k) in queries.items()]}
+        timeout = aiohttp.ClientTimeout(total=self.node_timeout)
+        try:
+            async with self.session.post(url_post, json=body, params=params, timeout=timeout) as response:
+                if response.status == 503:
+                    return "busy", await response.json(content_type=None)
+                response.raise_for_status()
+                return "ok", await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            print("Batch of " + str(len(queries)) + " queries failed on " + db_node)
+            print(traceback.format_exc())
+            return "failed", None
+
+    async def _query_batch(self, db_node, fragment, database, queries, on_result, on_busy, choose, is_alive,
+                           on_failed=None):
+        # Searches one fragment for several queries with one request to db_node.
+        # Queries the node refused or failed to search, or all of them if the request
+        # failed, are then sent one by one, preferably to another replica, with the
+        # retries and hedging of _query_fragment
+        start = self.loop.time()
+        status, data = await self._post_batch(db_node, database, queries)
+        remaining = queries
+        if status == "ok":
+            for answer in data["answers"]:
+                if self.tracer is not None:
+                    self.tracer.record("fragment", self.loop.time() - start, trace_id=answer["qid"],
+                                       attrs={"node": db_node, "batch": len(queries)}, fragment=fragment)
+                await self._callback(on_result, db_node, fragment, answer["qid"], answer)
+            remaining = {qid: queries[qid] for qid in data.get("refused", []) + data.get("failed", [])
+                         if qid in queries}
+        if remaining:
+            replica = await self._callback(choose, fragment, [db_node])
+            if replica is not None:
+                db_node, database = replica
+            await asyncio.gather(*(self._query_fragment(db_node, fragment, database, qid, sequence, top_k,
+                                                        on_result, on_busy, choose, is_alive, on_failed)
+                                   for qid, (sequence, top_k) in remaining.items()))
+
+    def send_batch(self, targets, queries, on_result, on_busy, choose, is_alive, on_failed=None):
+        # Sends several queries to all targets concurrently, one request per target,
+        # and returns immediately. queries is a dict from qid to (sequence, top_k),
+        # targets and callbacks are those of send_query
+        for db_node, fragment, database in targets:
+            print("Sending batch of " + str(len(queries)) + " queries to " + db_node)
+            self.submit(self._query_batch(db_node, fragment, database, queries,
+                                          on_result, on_busy, choose, is_alive, on_failed))
+
+    async def _probe(self, db_node, timeout):
+        # Checks one node's /status endpoint. Returns its health entry with
+        # round trip latency in seconds and the load the node reported
+        start = time.monotonic()
+        entry = {"alive": False, "latency": None, "load": {}, "checked": time.time()}
+        try:
+            async with self.session.get(db_node+"status",
+                                        timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                body = await response.text()
+                entry["alive"] = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return entry
+        entry["latency"] = time.monotonic() - start
+        try:
+            entry["load"] = json.loads(body)
+        except ValueError:
+            # Older nodes answer with plain text, treated as an idle node
+            entry["load"] = {"busy": False}
+        return entry
+
+    async def probe_nodes(self, nodes, timeout):
+        # Probes all nodes concurrently and returns a dict of node to health entry
+        entries = await asyncio.gather(*(self._probe(db_node, timeout) for db_node in nodes))
+        return dict(zip(nodes, entries))
+
+    async def _monitor(self, nodes, interval, timeout, on_update):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # on_update may write to disk, so it runs off the loop
+                health = await self.probe_nodes(nodes, timeout)
+                await self._callback(on_update, health)
+            except Exception:
+                print(traceback.format_exc())
+
+    def start_health_monitor(self, nodes, interval, timeout, on_update):
+        # Probes all nodes once before returning, then again every interval
+        # seconds in the background. on_update receives each new health table
+        on_update(self.run(self.probe_nodes(nodes, timeout)))
+        self.submit(self._monitor(nodes, interval, timeout, on_update))
@@ -0,0 +1,136 @@
+import asyncio
+import io
+import random
+import time
+from contextlib import nullcontext
+
+import aiohttp
+from Bio import Entrez
+
+
+class TokenBucket:
+    # Limits how often requests start. Tokens refill at rate per second up to
+    # capacity, and every request takes one token, waiting for it if needed
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self):
+        # The lock is created on first use so it belongs to the running loop
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class EntrezClient:
+    # This class calls the Entrez E-utilities from an asyncio loop. All calls share
+    # one token bucket so the server stays within NCBI's request rate (3 requests per
+    # second, or 10 with an API key), and each call has a timeout and is retried with
+    # exponential backoff when NCBI is unavailable or asks the client to slow down
+    def __init__(self, api_key=None, email=None, base_url="https://eutils.ncbi.nlm.nih.gov/entrez/eutils/",
+                 timeout=30, retries=3, backoff=0.5, tracer=None):
+        self.api_key = api_key
+        self.email = email
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.limiter = TokenBucket(10 if api_key else 3)
+        self.session = None
+        # Records the time of every call, including retries and waits for the limiter
+        self.tracer = tracer
+
+    def _params(self, params):
+        params = list(params)
+        if self.api_key:
+            params.append(("api_key", self.api_key))
+        if self.email:
+            params.append(("email", self.email))
+        return params
+
+    async def _open(self, util, params):
+        # Calls an E-utility, e.g. "efetch.fcgi", with a list of (name, value)
+        # parameters and returns the open response once its status is known.
+        # The caller must release the response
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        for attempt in range(self.retries + 1):
+            await self.limiter.acquire()
+            try:
+                response = await self.session.get(self.base_url + util, params=self._params(params),
+                                                  timeout=timeout)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            else:
+                # Too many requests and server errors are worth another try
+                if response.status != 429 and response.status < 500:
+                    if response.status >= 400:
+                        response.release()
+                        response.raise_for_status()
+                    return response
+                response.release()
+                error = aiohttp.ClientResponseError(response.request_info, response.history,
+                                                    status=response.status)
+            if attempt < self.retries:
+                await asyncio.sleep(self.backoff * 2**attempt * (1 + random.random()))
+        raise error
+
+    def _span(self, util, params):
+        if self.tracer is None:
+            return nullcontext()
+        db = dict(params).get("db")
+        return self.tracer.span("eutils", util=util.split(".")[0], db=db)
+
+    async def fetch(self, util, params):
+        # Calls an E-utility and returns the response body
+        with self._span(util, params):
+            response = await self._open(util, params)
+            try:
+                return await response.read()
+            finally:
+                response.release()
+
+    async def fetch_lines(self, util, params):
+        # Calls an E-utility and yields the response body one decoded line at a
+        # time as it arrives. Only failures before the body starts are retried
+        with self._span(util, params):
+            response = await self._open(util, params)
+            try:
+                async for line in response.content:
+                    yield line.decode()
+            finally:
+                response.release()
+
+    async def esummary(self, db, ids):
+        # Returns the summaries of the given ids, parsed by Bio.Entrez
+        data = await self.fetch("esummary.fcgi", [("db", db), ("id", ",".join(ids))])
+        return Entrez.read(io.BytesIO(data))
+
+    async def elink(self, dbfrom, db, link_name, ids):
+        # Returns the raw Elink XML. Each id is sent as its own parameter so
+        # the response has one LinkSet per id, in the same order
+        params = [("dbfrom", dbfrom), ("db", db), ("linkname", link_name)]
+        params.extend(("id", id) for id in ids)
+        return await self.fetch("elink.fcgi", params)
+
+    async def efetch(self, db, ids, rettype, retmode="text"):
+        # Returns the raw records of the given ids
+        return await self.fetch("efetch.fcgi", [("db", db), ("id", ",".join(ids)),
+                                                ("rettype", rettype), ("retmode", retmode)])
+
+    def efetch_lines(self, db, ids, rettype, retmode="text"):
+        # Returns an async iterator over the lines of the records of the given ids
+        return self.fetch_lines("efetch.fcgi", [("db", db), ("id", ",".join(ids)),
+                                                ("rettype", rettype), ("retmode", retmode)])
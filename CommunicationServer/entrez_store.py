@@ -0,0 +1,59 @@
+import json
+import time
+
+from sqlite_connections import ThreadConnections
+
+
+class EntrezStore:
+    # This class stores metadata fetched from the Entrez E-utilities in a SQLite
+    # database, so popular accessions and articles are only fetched from NCBI again
+    # once their entry is older than ttl seconds. Entries are grouped by kind:
+    #   links   - accession to its list of linked PubMed IDs
+    #   nuccore - accession to its parsed GenBank summary
+    #   pubmed  - PubMed ID to its parsed article summary
+    #   genbank - accession to the data parsed from its full GenBank file
+    def __init__(self, db_path, ttl=30 * 24 * 3600):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.connections = ThreadConnections(db_path)
+        self.hits = 0
+        self.misses = 0
+        self.connection().execute("""
+            CREATE TABLE IF NOT EXISTS records (
+                kind TEXT, key TEXT, data TEXT, fetched REAL, PRIMARY KEY (kind, key))
+        """)
+
+    def connection(self):
+        # Each thread uses its own connection
+        return self.connections.get()
+
+    def get_many(self, kind, keys):
+        # Returns a dict of the stored entries of the given kind that are
+        # younger than ttl. Keys without a fresh entry are left out
+        found = {}
+        keys = list(dict.fromkeys(keys))
+        oldest = time.time() - self.ttl
+        conn = self.connection()
+        # Stays well below SQLite's limit on query parameters
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT key, data FROM records WHERE kind = ? AND fetched >= ? AND key IN ({marks})",
+                [kind, oldest] + chunk).fetchall()
+            for key, data in rows:
+                found[key] = json.loads(data)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, kind, entries):
+        # Stores a dict of entries of the given kind, replacing older ones
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO records (kind, key, data, fetched) VALUES (?, ?, ?, ?)",
+                             [(kind, key, json.dumps(data), now) for key, data in entries.items()])
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
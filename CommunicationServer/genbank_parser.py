@@ -0,0 +1,72 @@
+class GenBankHeaderParser:
+    # This class parses the header of GenBank flat files one line at a time. It reads
+    # LOCUS, DEFINITION, ACCESSION, VERSION, SOURCE and every REFERENCE block, and
+    # skips everything from FEATURES or ORIGIN up to the "//" that ends the record,
+    # so the features and sequence are never stored. Feed it lines with feed(), which
+    # returns each record once its "//" line is read
+    # Keywords after which the rest of the record is skipped
+    SKIP_KEYWORDS = ("FEATURES", "ORIGIN", "CONTIG")
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.fields = {}
+        self.references = []
+        # Top level keyword of the block being read
+        self.block = None
+        # List the next continuation line is appended to
+        self.current = None
+        self.skipping = False
+
+    def feed(self, line):
+        # Parses one line. Returns the finished record when the line ends one
+        if line.startswith("//"):
+            record = self._finish()
+            self._reset()
+            return record
+        if self.skipping or not line.strip():
+            return None
+        if line[0] != " ":
+            # Top level keyword, e.g. "DEFINITION  text"
+            self.block = line[:12].strip()
+            if self.block in self.SKIP_KEYWORDS:
+                self.skipping = True
+                return None
+            if self.block == "REFERENCE":
+                self.references.append({})
+                self.current = self.references[-1].setdefault(self.block, [])
+            else:
+                self.current = self.fields.setdefault(self.block, [])
+            self.current.append(line[12:].strip())
+        elif line[:12].strip():
+            # Sub keyword, e.g. "  AUTHORS   text" or "   PUBMED   id". Only those of
+            # references are kept, ORGANISM under SOURCE holds the taxonomy which is not needed
+            if self.block == "REFERENCE":
+                self.current = self.references[-1].setdefault(line[:12].strip(), [])
+                self.current.append(line[12:].strip())
+            else:
+                self.current = None
+        elif self.current is not None:
+            # Continuation line, indented by 12 spaces
+            self.current.append(line.strip())
+        return None
+
+    def _finish(self):
+        record = {key: " ".join(value) for key, value in self.fields.items()}
+        record["REFERENCES"] = [{key: " ".join(value) for key, value in reference.items()}
+                                for reference in self.references]
+        # Only the first words of these lines are the name and ids
+        for key in ("LOCUS", "ACCESSION", "VERSION"):
+            if record.get(key):
+                record[key] = record[key].split()[0]
+        return record
+
+
+def parse_genbank_headers(lines):
+    # Yields the parsed header of each record in an iterable of GenBank flat file lines
+    parser = GenBankHeaderParser()
+    for line in lines:
+        record = parser.feed(line)
+        if record is not None:
+            yield record
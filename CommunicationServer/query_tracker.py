@@ -0,0 +1,154 @@
+import copy
+import threading
+from collections import deque
+
+
+class QueryTracker:
+    # This class is used to keep track of all requests made to the plugin to process data.
+    # Active queries are indexed by their id and pending ones wait in a FIFO queue, so
+    # every operation takes constant time regardless of how many queries are queued.
+    # All methods hold the tracker's lock since requests are served from several threads
+    def __init__(self, max_act_proc):
+        # Maximum number of queries being actively worked on
+        self.max_act_proc = max_act_proc
+        # Dict from qid to the active query's entry. Each entry holds its sequence,
+        # the number of best hits it asked for, the number of node results expected,
+        # and the results received per node id
+        self.query_process_list = {}
+        # FIFO of qids pending while the active process list is full, with
+        # a dict from qid to (sequence, top_k) for constant time lookups
+        self.query_process_queue = deque()
+        self.queued_queries = {}
+        # Active queries added with force, which do not take one of the max_act_proc slots
+        self.forced_queries = set()
+        self.lock = threading.RLock()
+
+    def exists(self, qid, check_list=True, check_queue=True):
+        # Checks if query exists in queue or list
+        with self.lock:
+            return ((check_list and qid in self.query_process_list)
+                    or (check_queue and qid in self.queued_queries))
+
+    def queue_len(self):
+        # Returns how many processes are in the queue
+        with self.lock:
+            return len(self.query_process_queue)
+
+    def active_len(self):
+        # Returns how many processes are in the active process list, not
+        # counting those added with force
+        with self.lock:
+            return len(self.query_process_list) - len(self.forced_queries)
+
+    def _activate(self, qid, sequence, top_k, expected):
+        self.query_process_list[qid] = {"sequence": sequence,
+                                        "top_k": top_k,
+                                        "expected": expected,
+                                        "results": {},
+                                        "processing": False}
+
+    def new(self, qid, sequence, expected, hold=False, top_k=None, force=False):
+        # Adds a query. expected is the number of node results the query waits
+        # for if it becomes active now. If hold is set the query always waits
+        # in the queue, with force it becomes active without taking a slot of
+        # max_act_proc. top_k is the number of best hits the query asked for
+        with self.lock:
+            # Returns -1 if duplicate
+            if self.exists(qid):
+                return -1
+            # Returns 1 if stored in active process list
+            if force or (not hold and self.active_len() < self.max_act_proc):
+                self._activate(qid, sequence, top_k, expected)
+                if force:
+                    self.forced_queries.add(qid)
+                return 1
+            # Returns 0 if stored in process queue
+            self.query_process_queue.append(qid)
+            self.queued_queries[qid] = (sequence, top_k)
+            return 0
+
+    def store_results(self, qid, nid, result):
+        # Stores the results a node sent for an active query. Returns False if the
+        # query is not active or that node's results were already stored
+        with self.lock:
+            entry = self.query_process_list.get(qid)
+            if entry is None or nid in entry["results"]:
+                return False
+            entry["results"][nid] = result
+            return True
+
+    def all_results_received(self, qid):
+        # Checks if all results were received for a given qid
+        with self.lock:
+            entry = self.query_process_list.get(qid)
+            return entry is not None and len(entry["results"]) >= entry["expected"]
+
+    def mark_processing(self, qid, force=False):
+        # Marks a query whose results are all received as being processed, or with
+        # force, a query still missing results. Returns True only to the first
+        # caller, so results are processed once
+        with self.lock:
+            entry = self.query_process_list.get(qid)
+            if entry is None or entry["processing"] or (not force and len(entry["results"]) < entry["expected"]):
+                return False
+            entry["processing"] = True
+            return True
+
+    def get_results(self, qid):
+        # Returns the results for a given qid
+        with self.lock:
+            return copy.deepcopy(list(self.query_process_list[qid]["results"].values()))
+
+    def reported(self, qid):
+        # Returns the ids of the nodes that sent results for an active query
+        with self.lock:
+            entry = self.query_process_list.get(qid)
+            return [str(nid) for nid in entry["results"]] if entry is not None else []
+
+    def top_k(self, qid):
+        # Returns how many best hits an active query asked for, or None if
+        # the query is no longer active or did not ask for a number
+        with self.lock:
+            entry = self.query_process_list.get(qid)
+            return entry["top_k"] if entry is not None else None
+
+    def expected(self, qid):
+        # Returns how many node results an active query waits for, or 0 if
+        # the query is no longer active
+        with self.lock:
+            entry = self.query_process_list.get(qid)
+            return entry["expected"] if entry is not None else 0
+
+    def delete_entry_from_proc_list(self, qid):
+        # Deletes process and results from query_process_list if it exists
+        with self.lock:
+            self.forced_queries.discard(qid)
+            return self.query_process_list.pop(qid, None) is not None
+
+    def status(self, qid):
+        # Returns the status of a given request
+        # -2 means the process does not exist
+        # -1 means the process is in the queue
+        # A positive, non-zero integer means how many
+        # requests have been received from the db nodes
+        with self.lock:
+            if qid in self.query_process_list:
+                return len(self.query_process_list[qid]["results"])
+            if qid in self.queued_queries:
+                return -1
+            return -2
+
+    def reap(self):
+        # Returns the active queries whose process is gone. Queries are only tracked
+        # by this process, which runs them all, so there are none
+        return []
+
+    def insert_proc_from_queue(self, expected):
+        # Moves a process from the queue into the list of active processes
+        with self.lock:
+            if not self.query_process_queue or self.active_len() >= self.max_act_proc:
+                return False
+            qid = self.query_process_queue.popleft()
+            sequence, top_k = self.queued_queries.pop(qid)
+            self._activate(qid, sequence, top_k, expected)
+            return {"qid": qid, "sequence": sequence, "top_k": top_k}
@@ -0,0 +1,183 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    # This class caches processed query results. Every result is stored on disk in
+    # cache_dir as a JSON file named by its query id, so the cache persists across
+    # restarts. An in-memory LRU index of the stored entries makes lookups constant
+    # time, and the most recently used results are also kept in memory, up to
+    # memory_bytes, so they are served without reading the disk
+    def __init__(self, cache_dir, max_entries=1000, max_bytes=512 * 2**20,
+                 memory_bytes=64 * 2**20, ttl=7 * 24 * 3600):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        # Seconds a result stays valid, None to keep results until evicted
+        self.ttl = ttl
+        # Dict from key to (size in bytes, creation time) of every stored entry,
+        # ordered from least to most recently used
+        self.index = OrderedDict()
+        self.disk_used = 0
+        # Serialized results kept in memory, ordered from least to most recently used
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def _valid(key):
+        # Keys name files directly in cache_dir, so they cannot be paths, hidden
+        # files or references to a parent directory
+        return (isinstance(key, str) and key != "" and not key.startswith(".") and ".." not in key
+                and "/" not in key and os.sep not in key and (os.altsep is None or os.altsep not in key)
+                and "\0" not in key)
+
+    def _path(self, key):
+        if not self._valid(key):
+            raise ValueError(f"Invalid cache key {key!r}")
+        return os.path.join(self.cache_dir, key)
+
+    def _load_index(self):
+        # Rebuilds the index from the files on disk, oldest first. This is the
+        # only time the cache directory is listed
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self.index[key] = (size, mtime)
+            self.disk_used += size
+        self._evict()
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _adopt(self, key):
+        # Adds an entry written by another server process to the index
+        try:
+            stat = os.stat(self._path(key))
+        except OSError:
+            return False
+        self.index[key] = (stat.st_size, stat.st_mtime)
+        self.disk_used += stat.st_size
+        self._evict()
+        return key in self.index
+
+    def _remove(self, key):
+        size, created = self.index.pop(key)
+        self.disk_used -= size
+        data = self.memory.pop(key, None)
+        if data is not None:
+            self.memory_used -= len(data)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # Removes least recently used entries until the cache is within its limits
+        while self.index and (len(self.index) > self.max_entries or self.disk_used > self.max_bytes):
+            self._remove(next(iter(self.index)))
+            self.evictions += 1
+        while self.memory_used > self.memory_bytes:
+            key, data = self.memory.popitem(last=False)
+            self.memory_used -= len(data)
+
+    def _remember(self, key, data):
+        # Keeps a serialized result in memory as the most recently used one
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        if len(data) > self.memory_bytes:
+            return
+        self.memory[key] = data
+        self.memory_used += len(data)
+        self._evict()
+
+    def _lookup(self, key):
+        # Returns True if key is stored and still valid, marking it as recently used
+        if not self._valid(key):
+            return False
+        if key not in self.index and not self._adopt(key):
+            return False
+        if self._expired(self.index[key][1]):
+            self._remove(key)
+            self.evictions += 1
+            return False
+        self.index.move_to_end(key)
+        return True
+
+    def contains(self, key):
+        # Checks if a valid result is cached for key
+        with self.lock:
+            found = self._lookup(key)
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found
+
+    def get(self, key):
+        # Returns the cached result for key, or None if there is none
+        with self.lock:
+            if not self._lookup(key):
+                self.misses += 1
+                return None
+            data = self.memory.get(key)
+            if data is None:
+                try:
+                    with open(self._path(key), "rb") as qfile:
+                        data = qfile.read()
+                except OSError:
+                    # Removed by another server process
+                    size, created = self.index.pop(key)
+                    self.disk_used -= size
+                    self.misses += 1
+                    return None
+                self._remember(key, data)
+            else:
+                self.memory.move_to_end(key)
+            self.hits += 1
+        return json.loads(data)
+
+    def put(self, key, result):
+        # Stores a result, replacing any previous result for key
+        data = json.dumps(result).encode()
+        path = self._path(key)
+        # Writes to a temporary file first so readers never see a partial result
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as qfile:
+            qfile.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if key in self.index:
+                self.disk_used -= self.index.pop(key)[0]
+                old = self.memory.pop(key, None)
+                if old is not None:
+                    self.memory_used -= len(old)
+            self.index[key] = (len(data), time.time())
+            self.disk_used += len(data)
+            self._remember(key, data)
+            self._evict()
+
+    def stats(self):
+        # Returns the cache's counters and current size
+        with self.lock:
+            return {"entries": len(self.index),
+                    "bytes": self.disk_used,
+                    "memory_entries": len(self.memory),
+                    "memory_bytes": self.memory_used,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
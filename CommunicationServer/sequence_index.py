@@ -0,0 +1,86 @@
+import json
+import time
+
+from sqlite_connections import ThreadConnections
+
+
+class SequenceIndex:
+    # This class keeps the top BLAST hits found for every sequence that was resolved,
+    # keyed by the md5 hash of the normalized sequence, in a SQLite database. Only the
+    # accessions and their scores are stored, so the index holds far more sequences than
+    # the result cache and lets a query for a known sequence skip BLAST entirely.
+    # Each entry also records how many hits were asked for, so it can answer any
+    # query for that many hits or fewer
+    def __init__(self, db_path, ttl=30 * 24 * 3600, max_entries=1000000, prune_every=1000):
+        self.db_path = db_path
+        # Seconds an entry stays valid, so hits are searched again once the
+        # databases on the nodes may have been updated
+        self.ttl = ttl
+        # Most entries kept, the oldest are deleted beyond it. Expired entries and
+        # those over the limit are deleted every prune_every stored entries
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self.connections = ThreadConnections(db_path)
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        conn = self.connection()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sequences (
+                key TEXT PRIMARY KEY, top_k INTEGER, results TEXT, stored REAL)
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS sequences_stored ON sequences (stored)")
+        self.prune()
+
+    def connection(self):
+        # Each thread uses its own connection
+        return self.connections.get()
+
+    def get(self, keys, top_k):
+        # Returns the top_k best hits stored under the first of keys that can answer
+        # a query for top_k hits, or None if none can. An entry answers if it was
+        # stored for at least top_k hits, or holds every hit its sequence has
+        oldest = time.time() - self.ttl
+        conn = self.connection()
+        for key in keys:
+            row = conn.execute("SELECT top_k, results FROM sequences WHERE key = ? AND stored >= ?",
+                               (key, oldest)).fetchone()
+            if row is None:
+                continue
+            results = json.loads(row[1])
+            if top_k <= row[0] or len(results) < row[0]:
+                self.hits += 1
+                return results[:top_k]
+        self.misses += 1
+        return None
+
+    def put(self, key, top_k, results):
+        # Stores the hits found for a query for top_k hits. An entry stored
+        # for more hits is only replaced once it is no longer valid
+        results = [{"accession": result["accession"], "score": result["score"],
+                    "per_cov": result["per_cov"], "per_id": result["per_id"]} for result in results]
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            conn.execute("""
+                INSERT INTO sequences (key, top_k, results, stored) VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET top_k = excluded.top_k, results = excluded.results,
+                    stored = excluded.stored
+                WHERE excluded.top_k >= sequences.top_k OR sequences.stored < ?
+            """, (key, top_k, json.dumps(results), now, now - self.ttl))
+        self.stored += 1
+        if self.stored % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        # Deletes expired entries, then the oldest entries beyond max_entries
+        conn = self.connection()
+        with conn:
+            conn.execute("DELETE FROM sequences WHERE stored < ?", (time.time() - self.ttl,))
+            conn.execute("""
+                DELETE FROM sequences WHERE key IN (
+                    SELECT key FROM sequences ORDER BY stored DESC LIMIT -1 OFFSET ?)
+            """, (self.max_entries,))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,75 @@
+import json
+
+
+class ShardMap:
+    # This class maps the fragments of the BLAST database (e.g. the nt.00, nt.01 ...
+    # volumes) to the database nodes that hold a copy of them. A node can hold several
+    # fragments and a fragment can be replicated on several nodes. Each query is sent
+    # once per fragment, to one live replica chosen by load, and is complete once every
+    # fragment has answered
+    def __init__(self, fragments, named=True):
+        # Dict from fragment name to its list of replica node addresses
+        self.fragments = fragments
+        # Whether fragments are database names. If not, each fragment is
+        # a node's address and the node searches its default database
+        self.named = named
+        self.nodes = list(dict.fromkeys(node for replicas in fragments.values() for node in replicas))
+
+    @classmethod
+    def from_file(cls, path):
+        # Reads a JSON file mapping each fragment to the IP addresses of its replicas:
+        #   {"nt.00": ["10.0.0.1", "10.0.0.2"], "nt.01": ["10.0.0.2"]}
+        with open(path, "r") as f:
+            shards = json.loads(f.read())
+        return cls({fragment: [f"http://{ip}/" for ip in ips] for fragment, ips in shards.items()})
+
+    @classmethod
+    def from_nodes(cls, nodes):
+        # Every node is its own fragment and searches its default database
+        return cls({node: [node] for node in nodes}, named=False)
+
+    def database(self, fragment):
+        # Returns the database a node is asked to search for a fragment,
+        # None if the node searches its default database
+        return fragment if self.named else None
+
+    def assign(self, node_health, fragments=None):
+        # Chooses one live replica for each fragment, or for each of the given
+        # fragments, and returns a dict from fragment to node. Fragments with
+        # fewer replicas are assigned first, and each goes to the replica with the
+        # least queries running, queued or already assigned here. Fragments
+        # without a live replica are left out
+        assigned = {}
+        extra = {}
+        if fragments is None:
+            fragments = list(self.fragments)
+        for fragment in sorted(fragments, key=lambda f: len(self.fragments[f])):
+            live = [node for node in self.fragments[fragment] if node_health.get(node, {}).get("alive")]
+            if not live:
+                continue
+            node = min(live, key=lambda node: self._load(node_health[node], extra.get(node, 0)))
+            assigned[fragment] = node
+            extra[node] = extra.get(node, 0) + 1
+        return assigned
+
+    def choose(self, node_health, fragment, exclude=()):
+        # Returns the least loaded live replica of a fragment that is not in
+        # exclude, or None if there is none
+        live = [node for node in self.fragments[fragment]
+                if node not in exclude and node_health.get(node, {}).get("alive")]
+        if not live:
+            return None
+        return min(live, key=lambda node: self._load(node_health[node], 0))
+
+    @staticmethod
+    def _load(entry, assigned):
+        # Orders replicas by whether they refuse queries, then by the queries they
+        # run or hold plus those assigned to them by this dispatch, then by latency
+        load = entry["load"]
+        return (bool(load.get("busy")), load.get("active", 0) + load.get("queued", 0) + assigned,
+                entry["latency"] or 0)
+
+    def available(self, node_health):
+        # Returns the fragments that have at least one live replica
+        return [fragment for fragment, replicas in self.fragments.items()
+                if any(node_health.get(node, {}).get("alive") for node in replicas)]
@@ -0,0 +1,22 @@
+import sqlite3
+import threading
+
+
+class ThreadConnections:
+    # This class opens one connection per thread to a SQLite database in WAL mode,
+    # so readers do not block the writer and several threads and server processes
+    # can share the file. Keyword arguments are passed on to sqlite3.connect
+    def __init__(self, db_path, **kwargs):
+        self.db_path = db_path
+        self.kwargs = kwargs
+        self.local = threading.local()
+
+    def get(self):
+        # Returns the calling thread's connection, opening it on first use
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, **self.kwargs)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
@@ -0,0 +1,312 @@
+import json
+import os
+import time
+import uuid
+from collections.abc import MutableMapping
+
+from query_tracker import QueryTracker
+from sqlite_connections import ThreadConnections
+
+
+class MemoryStateBackend:
+    # Keeps the query tracker, the results ready to be read, the provisional results,
+    # the queries of bulk requests waiting to be searched and the database node health
+    # table in this process's memory. Only usable with a single server process
+    def __init__(self, max_act_proc):
+        self.tracker = QueryTracker(max_act_proc)
+        self.ready_results = {}
+        self.provisional_results = {}
+        self.bulk_queries = {}
+        self.node_health = {}
+
+    def heartbeat(self):
+        # Only this process runs the queries it tracks
+        pass
+
+
+class SQLiteStateBackend:
+    # Keeps the query tracker, the results ready to be read, the provisional results,
+    # the queries of bulk requests waiting to be searched and the database node health
+    # table in a SQLite database, so several server processes on the same machine
+    # share them. Each thread uses its own connection.
+    # Every active query records the process that runs it and the time by which it
+    # must have finished. query_timeout is how long a query may stay active, and a
+    # process is considered gone once it has not called heartbeat() for owner_timeout
+    # seconds, e.g. after a restart or when a worker dies
+    def __init__(self, db_path, max_act_proc, query_timeout=600, owner_timeout=60):
+        self.db_path = db_path
+        self.query_timeout = query_timeout
+        self.owner_timeout = owner_timeout
+        # Id of this process in the owners table. Process ids are reused across
+        # restarts, e.g. every container's server is pid 1, so a random id is added
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex}"
+        # Autocommit mode, transactions are started explicitly
+        self.connections = ThreadConnections(db_path, isolation_level=None)
+        self.connection().executescript("""
+            CREATE TABLE IF NOT EXISTS active (
+                qid TEXT PRIMARY KEY, sequence TEXT, expected INTEGER,
+                processing INTEGER DEFAULT 0, top_k INTEGER, forced INTEGER DEFAULT 0,
+                owner TEXT, deadline REAL);
+            CREATE TABLE IF NOT EXISTS results (
+                qid TEXT, nid TEXT, result TEXT, PRIMARY KEY (qid, nid));
+            CREATE TABLE IF NOT EXISTS pending (
+                pos INTEGER PRIMARY KEY AUTOINCREMENT, qid TEXT UNIQUE, sequence TEXT,
+                top_k INTEGER);
+            CREATE TABLE IF NOT EXISTS ready_results (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS provisional_results (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS bulk_queries (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS node_health (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, seen REAL);
+        """)
+        self._add_columns({"active": ["top_k INTEGER", "forced INTEGER DEFAULT 0", "owner TEXT", "deadline REAL"],
+                           "pending": ["top_k INTEGER"]})
+        self.heartbeat()
+        self.tracker = SQLiteQueryTracker(self, max_act_proc)
+        self.ready_results = SQLiteTable(self, "ready_results")
+        self.provisional_results = SQLiteTable(self, "provisional_results")
+        self.bulk_queries = SQLiteTable(self, "bulk_queries")
+        self.node_health = SQLiteTable(self, "node_health")
+
+    def _add_columns(self, columns):
+        # Adds columns missing from a database created by an older version
+        conn = self.connection()
+        for table, table_columns in columns.items():
+            existing = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+            for column in table_columns:
+                if column.split()[0] not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+    def connection(self):
+        return self.connections.get()
+
+    def transaction(self):
+        return _Transaction(self.connection())
+
+    def heartbeat(self):
+        # Records that this process is still running its active queries
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO owners (owner, seen) VALUES (?, ?)",
+                         (self.owner, time.time()))
+
+    def active_row(self):
+        # Owner and deadline columns of a query that becomes active now
+        return self.owner, time.time() + self.query_timeout
+
+
+class _Transaction:
+    # Runs a block in an immediate transaction, so writes from other processes
+    # wait until it commits. Nested use on the same connection joins the outer one
+    def __init__(self, conn):
+        self.conn = conn
+        self.outer = not conn.in_transaction
+
+    def __enter__(self):
+        if self.outer:
+            self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.outer:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+class SQLiteTable(MutableMapping):
+    # Dict-like view of a key/value table. Values are stored as JSON, so nested
+    # values must be assigned again after being changed
+    def __init__(self, backend, table):
+        self.backend = backend
+        self.table = table
+
+    def __getitem__(self, key):
+        row = self.backend.connection().execute(
+            f"SELECT value FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def __setitem__(self, key, value):
+        with self.backend.transaction() as conn:
+            conn.execute(f"INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)",
+                         (key, json.dumps(value)))
+
+    def __delitem__(self, key):
+        with self.backend.transaction() as conn:
+            if conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,)).rowcount == 0:
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        return self.backend.connection().execute(
+            f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        rows = self.backend.connection().execute(f"SELECT key FROM {self.table}").fetchall()
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self.backend.connection().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+    def pop(self, key, *default):
+        # Reads and deletes in one transaction, so only one process gets the value
+        with self.backend.transaction():
+            try:
+                value = self[key]
+            except KeyError:
+                if default:
+                    return default[0]
+                raise
+            del self[key]
+            return value
+
+
+class SQLiteQueryTracker:
+    # QueryTracker with the same interface, storing its state in SQLite so that
+    # every server process sees the same active and pending queries
+    def __init__(self, backend, max_act_proc):
+        self.backend = backend
+        self.max_act_proc = max_act_proc
+
+    def _query(self, sql, args=()):
+        return self.backend.connection().execute(sql, args)
+
+    def exists(self, qid, check_list=True, check_queue=True):
+        # Checks if query exists in queue or list
+        if check_list and self._query("SELECT 1 FROM active WHERE qid = ?", (qid,)).fetchone():
+            return True
+        if check_queue and self._query("SELECT 1 FROM pending WHERE qid = ?", (qid,)).fetchone():
+            return True
+        return False
+
+    def queue_len(self):
+        # Returns how many processes are in the queue
+        return self._query("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def active_len(self):
+        # Returns how many processes are in the active process list, not
+        # counting those added with force
+        return self._query("SELECT COUNT(*) FROM active WHERE forced = 0").fetchone()[0]
+
+    def new(self, qid, sequence, expected, hold=False, top_k=None, force=False):
+        # Adds a query. expected is the number of node results the query waits
+        # for if it becomes active now. If hold is set the query always waits
+        # in the queue, with force it becomes active without taking a slot of
+        # max_act_proc. top_k is the number of best hits the query asked for
+        with self.backend.transaction() as conn:
+            # Returns -1 if duplicate
+            if self.exists(qid):
+                return -1
+            # Returns 1 if stored in active process list
+            if force or (not hold and self.active_len() < self.max_act_proc):
+                conn.execute("INSERT INTO active (qid, sequence, expected, top_k, forced, owner, deadline) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (qid, sequence, expected, top_k, int(force), *self.backend.active_row()))
+                return 1
+            # Returns 0 if stored in process queue
+            conn.execute("INSERT INTO pending (qid, sequence, top_k) VALUES (?, ?, ?)",
+                         (qid, sequence, top_k))
+            return 0
+
+    def store_results(self, qid, nid, result):
+        # Stores the results a node sent for an active query. Returns False if the
+        # query is not active or that node's results were already stored
+        with self.backend.transaction() as conn:
+            if not self.exists(qid, check_queue=False):
+                return False
+            cursor = conn.execute("INSERT OR IGNORE INTO results (qid, nid, result) VALUES (?, ?, ?)",
+                                  (qid, str(nid), json.dumps(result)))
+            return cursor.rowcount == 1
+
+    def _received(self, qid):
+        return self._query("SELECT COUNT(*) FROM results WHERE qid = ?", (qid,)).fetchone()[0]
+
+    def all_results_received(self, qid):
+        # Checks if all results were received for a given qid
+        expected = self._query("SELECT expected FROM active WHERE qid = ?", (qid,)).fetchone()
+        return expected is not None and self._received(qid) >= expected[0]
+
+    def mark_processing(self, qid, force=False):
+        # Marks a query whose results are all received as being processed, or with
+        # force, a query still missing results. Returns True only to the first
+        # caller, so results are processed once
+        with self.backend.transaction() as conn:
+            row = conn.execute("SELECT expected, processing FROM active WHERE qid = ?",
+                               (qid,)).fetchone()
+            if row is None or row[1] or (not force and self._received(qid) < row[0]):
+                return False
+            conn.execute("UPDATE active SET processing = 1 WHERE qid = ?", (qid,))
+            return True
+
+    def get_results(self, qid):
+        # Returns the results for a given qid
+        rows = self._query("SELECT result FROM results WHERE qid = ?", (qid,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def reported(self, qid):
+        # Returns the ids of the nodes that sent results for an active query
+        rows = self._query("SELECT nid FROM results WHERE qid = ?", (qid,)).fetchall()
+        return [row[0] for row in rows]
+
+    def top_k(self, qid):
+        # Returns how many best hits an active query asked for, or None if
+        # the query is no longer active or did not ask for a number
+        row = self._query("SELECT top_k FROM active WHERE qid = ?", (qid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def expected(self, qid):
+        # Returns how many node results an active query waits for, or 0 if
+        # the query is no longer active
+        row = self._query("SELECT expected FROM active WHERE qid = ?", (qid,)).fetchone()
+        return row[0] if row is not None else 0
+
+    def delete_entry_from_proc_list(self, qid):
+        # Deletes process and results from the active processes if it exists
+        with self.backend.transaction() as conn:
+            conn.execute("DELETE FROM results WHERE qid = ?", (qid,))
+            return conn.execute("DELETE FROM active WHERE qid = ?", (qid,)).rowcount == 1
+
+    def status(self, qid):
+        # Returns the status of a given request
+        # -2 means the process does not exist
+        # -1 means the process is in the queue
+        # A positive, non-zero integer means how many
+        # requests have been received from the db nodes
+        if self.exists(qid, check_queue=False):
+            return self._received(qid)
+        if self.exists(qid, check_list=False):
+            return -1
+        return -2
+
+    def insert_proc_from_queue(self, expected):
+        # Moves a process from the queue into the list of active processes
+        with self.backend.transaction() as conn:
+            if self.active_len() >= self.max_act_proc:
+                return False
+            row = conn.execute("SELECT pos, qid, sequence, top_k FROM pending ORDER BY pos LIMIT 1").fetchone()
+            if row is None:
+                return False
+            conn.execute("DELETE FROM pending WHERE pos = ?", (row[0],))
+            conn.execute("INSERT INTO active (qid, sequence, expected, top_k, owner, deadline) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (row[1], row[2], expected, row[3], *self.backend.active_row()))
+            return {"qid": row[1], "sequence": row[2], "top_k": row[3]}
+
+    def reap(self):
+        # Moves active queries that are past their deadline, or whose process stopped
+        # sending heartbeats, back to the front of the queue so they are started again,
+        # and drops the results they had. Their processes took their requests and
+        # deadline timers with them, so nothing else would free their slots.
+        # Returns the qids moved
+        now = time.time()
+        with self.backend.transaction() as conn:
+            conn.execute("DELETE FROM owners WHERE seen < ?", (now - self.backend.owner_timeout,))
+            rows = conn.execute("""
+                SELECT qid, sequence, top_k FROM active
+                WHERE deadline IS NULL OR deadline < ?
+                    OR owner IS NULL OR owner NOT IN (SELECT owner FROM owners)
+            """, (now,)).fetchall()
+            first = conn.execute("SELECT MIN(pos) FROM pending").fetchone()[0] or 1
+            for i, (qid, sequence, top_k) in enumerate(reversed(rows)):
+                conn.execute("DELETE FROM results WHERE qid = ?", (qid,))
+                conn.execute("DELETE FROM active WHERE qid = ?", (qid,))
+                conn.execute("INSERT OR IGNORE INTO pending (pos, qid, sequence, top_k) VALUES (?, ?, ?, ?)",
+                             (first - 1 - i, qid, sequence, top_k))
+            return [row[0] for row in rows]
@@ -0,0 +1,107 @@
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Trace id of the query the running code works for. Set in a coroutine, it is
+# inherited by the tasks it starts, so E-utilities calls are traced to their query
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+async def traced(trace_id, coro):
+    # Runs a coroutine as part of a trace
+    current_trace.set(trace_id)
+    return await coro
+
+
+class Tracer:
+    # This class records timed spans of each query's stages under the query's trace id,
+    # keeping the spans of the latest max_traces queries, and aggregates every span's
+    # duration into Prometheus histograms labelled by span name and its labels
+    BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, prefix, max_traces=500):
+        self.prefix = prefix
+        self.max_traces = max_traces
+        # Dict from trace id to its list of spans, oldest trace first
+        self.traces = OrderedDict()
+        # Dict from (span name, labels) to [bucket counts, count, sum]
+        self.histograms = {}
+        # Dict from (counter name, labels) to its value
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def record(self, name, duration, trace_id=None, start=None, attrs=None, **labels):
+        # Records a span that took duration seconds. Spans without a trace id
+        # belong to the current trace, or only count towards the metrics. attrs
+        # are only added to the trace, labels to the trace and the metrics
+        if trace_id is None:
+            trace_id = current_trace.get()
+        if start is None:
+            start = time.time() - duration
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            histogram = self.histograms.setdefault(key, [[0] * len(self.BUCKETS), 0, 0.0])
+            for i, bound in enumerate(self.BUCKETS):
+                if duration <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += duration
+            self._add(trace_id, dict(attrs or {}, **labels, name=name, start=start, duration=duration))
+
+    @contextmanager
+    def span(self, name, trace_id=None, attrs=None, **labels):
+        # Times the block it wraps as a span
+        start = time.time()
+        began = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, time.monotonic() - began, trace_id=trace_id, start=start, attrs=attrs, **labels)
+
+    def count(self, name, trace_id=None, attrs=None, **labels):
+        # Adds one to a counter, and marks the event in the trace
+        if trace_id is None:
+            trace_id = current_trace.get()
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            self._add(trace_id, dict(attrs or {}, **labels, name=name, start=time.time(), duration=0))
+
+    def _add(self, trace_id, span):
+        # Adds a span to its trace, dropping the oldest traces beyond max_traces
+        if trace_id is None:
+            return
+        self.traces.setdefault(trace_id, []).append(span)
+        self.traces.move_to_end(trace_id)
+        while len(self.traces) > self.max_traces:
+            self.traces.popitem(last=False)
+
+    def trace(self, trace_id):
+        # Returns the spans of a trace ordered by start time, or None if it is unknown
+        with self.lock:
+            spans = self.traces.get(trace_id)
+            return None if spans is None else sorted(spans, key=lambda span: span["start"])
+
+    def prometheus(self):
+        # Returns all metrics in the Prometheus text exposition format
+        def format_labels(labels):
+            return ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"'))
+                            for k, v in labels)
+
+        name = self.prefix + "_span_seconds"
+        lines = [f"# TYPE {name} histogram"]
+        with self.lock:
+            for (span, labels), (buckets, count, total) in sorted(self.histograms.items()):
+                labels = format_labels((("span", span),) + labels)
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {bucket}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f"{name}_count{{{labels}}} {count}")
+                lines.append(f"{name}_sum{{{labels}}} {total}")
+            name = self.prefix + "_events_total"
+            lines.append(f"# TYPE {name} counter")
+            for (event, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{{{format_labels((('event', event),) + labels)}}} {value}")
+        return "\n".join(lines) + "\n"
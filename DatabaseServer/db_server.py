@@ -1,9 +1,17 @@
-from flask import Flask, request, make_response
+from flask import Flask, Response, request, make_response, jsonify
 import json
 import docker
 import threading
-import os
+import heapq
+import queue
+import atexit
+import traceback
 import time
+import uuid
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import Future
+import os
 from pathlib import Path
 import requests as http_req
 
@@ -12,96 +20,558 @@ app = Flask(__name__)
 db = 'nt.00'
 nid = '1'
 HOME = '/home/ec2-user/'
+# Fragments this node can search. node_config.json, if present, sets the node id
+# and its fragments, so a node can hold several: {"nid": "2", "dbs": ["nt.01", "nt.02"]}
+# The first fragment is searched when a request does not name one
+dbs = [db]
+if os.path.exists("node_config.json"):
+    with open("node_config.json", "r") as config_f:
+        node_config = json.loads(config_f.read())
+    nid = str(node_config.get("nid", nid))
+    dbs = node_config.get("dbs", dbs)
 # in seconds
 tout = 600
+# Number of best hits each query reports to the server unless it asks for another
+# number, and the most hits a query may ask for
+top_k = 10
+max_top_k = 500
+
 
+# Number of warm BLAST containers kept alive on this node
+pool_size = 2
+# Maximum number of queries waiting for a free worker. Requests beyond this
+# are refused with 503 so the server can hold them back instead
+max_pending = 64
+# Queue of (qid, reply, k, name, content, trace) jobs waiting for a free worker. reply
+# is either the IP address to post results back to, or a Future the request is waiting
+# on, k is the number of best hits the query asked for, name the fragment to search,
+# content the query's FASTA text, and trace the query's trace id and queueing time
+job_queue = queue.Queue(maxsize=max_pending)
+# Number of queries currently being searched by the workers
+active_jobs = 0
+active_lock = threading.Lock()
+# Queries for the same fragment that arrive within batch_window seconds of each
+# other are searched together in one blastn run, up to max_batch queries per batch
+batch_window = 0.5
+max_batch = 16
+# Batch query files are written to this tmpfs directory, so queries never touch the disk
+query_dir = '/dev/shm/blast_queries'
+# Number of (sequence, fragment) results kept in memory, so a sequence searched
+# again is answered without running BLAST
+result_cache_size = 1024
+# Mounts local directories inside docker container
+volume_dict = {os.path.join(HOME, 'blastdb'): {'bind': '/blast/blastdb', 'mode': 'ro'},
+               os.path.join(HOME, 'blastdb_custom'): {'bind': '/blast/blastdb_custom', 'mode': 'ro'},
+               query_dir: {'bind': '/blast/queries', 'mode': 'ro'}
+               }
+workers = []
+# Timed spans of the latest max_traces queries, by trace id, and the count
+# and total seconds of every span name and fragment, served on /metrics
+max_traces = 500
+traces = OrderedDict()
+span_totals = {}
+trace_lock = threading.Lock()
 
-def run_docker(qid, remote_ip):
-    """ This function runs a blast search in a docker container, returns the top 10 results
-        with score, query coverage, and percent identity
+
+def record_span(trace_id, name, duration, db=None, **attrs):
+    """ Records a span of duration seconds under a trace id, or only in the metrics
+        if trace_id is None, and returns it
     """
-    fasta = "/blast/queries/{}.fsa".format(qid)
-    results = "/blast/results/{}.out".format(qid)
-    docker_client = docker.from_env()
-    # Command to run, it limits results to:
-    # Accession ID, Score, Query Coverage, and Identity Percentage
-    cmnd = "blastn -query {} -db {} -out {} -outfmt \"6 sacc score qcovhsp pident\"".format(
-        fasta, db, results)
-    # Mounts local directories inside docker container
-    volume_dict = {os.path.join(HOME, 'blastdb'): {'bind': '/blast/blastdb', 'mode': 'ro'},
-                   os.path.join(HOME, 'blastdb_custom'): {'bind': '/blast/blastdb_custom', 'mode': 'ro'},
-                   os.path.join(HOME, 'queries'): {'bind': '/blast/queries', 'mode': 'ro'},
-                   os.path.join(HOME, 'results'): {'bind': '/blast/results', 'mode': 'rw'}
-                   }
+    span = dict(attrs, name=name, duration=duration)
+    if db is not None:
+        span['db'] = db
+    with trace_lock:
+        totals = span_totals.setdefault((name, db or ""), [0, 0.0])
+        totals[0] += 1
+        totals[1] += duration
+        if trace_id is not None:
+            traces.setdefault(trace_id, []).append(span)
+            traces.move_to_end(trace_id)
+            while len(traces) > max_traces:
+                traces.popitem(last=False)
+    return span
 
+
+def start_container(docker_client):
+    """ Starts a long-lived ncbi/blast container that idles until searches are
+        executed inside it, and reads the databases once so their pages are hot in the OS cache
+    """
+    start = time.monotonic()
     container = docker_client.containers.run(
-        image='ncbi/blast', command=cmnd, volumes=volume_dict, detach=True)
-    
-    timeout_reached = True
-    # Check status of docker execution every 1 second
-    for i in range(tout):
-        container.reload()
-        print(container.status)
-        if container.status == 'exited':
-            timeout_reached = False
-            break
-        time.sleep(1)
-    container.remove(force=True)
-
-    # Build json response to server
-    local_r = os.path.join(HOME, "results", "{}.out".format(qid))
-    local_f = os.path.join(HOME, "queries", "{}.fsa".format(qid))
-    r_dict = {}
-    r_dict['qid'] = qid
-    r_dict['nid'] = nid
-    r_dict['results'] = []
-    if not timeout_reached:
-        # If results exist
-        with open(local_r, 'r') as rfile:
-            for i in range(10):
-                metrics = {}
-                line = rfile.readline()[:-1]
-                values = line.split("\t")
-                if values[0]:
-                    metrics['accession'] = values[0]
-                    metrics['score'] = int(values[1])
-                    metrics['per_cov'] = float(values[2])
-                    metrics['per_id'] = float(values[3])
-                    r_dict['results'].append(metrics)
-
-    # Delete files when complete
-    os.remove(local_r)
-    os.remove(local_f)
-
-    #Send response
-    url = "http://{}:80/node_data/{}".format(remote_ip, qid)
+        image='ncbi/blast', command='sleep infinity', volumes=volume_dict, detach=True)
+    for name in dbs:
+        container.exec_run(
+            "sh -c \"cat /blast/blastdb/{}.* > /dev/null\"".format(name))
+    record_span(None, "container_start", time.monotonic() - start)
+    return container
+
+
+def build_batch_fasta(jobs, batch_id):
+    """ Writes the queries of a batch into one multi-sequence query file in query_dir.
+        Every record's header is replaced with its qid so blastn reports it as the qseqid,
+        and a query queued twice is only searched once
+    """
+    batch_f = os.path.join(query_dir, "{}.fsa".format(batch_id))
+    written = set()
+    with open(batch_f, "w") as out_f:
+        for qid, reply, k, name, content, trace in jobs:
+            if qid in written:
+                continue
+            written.add(qid)
+            if not content.lstrip().startswith(">"):
+                out_f.write(">{}\n".format(qid))
+            for line in content.splitlines():
+                if line.startswith(">"):
+                    line = ">{}".format(qid)
+                out_f.write(line + "\n")
+    return batch_f
+
+
+def sequence_key(content, name):
+    """ Returns the result cache key of a query: the md5 hash of its sequence without
+        headers, whitespace or case, and the fragment searched. Records stay separated
+        by ">", so a query of several records never shares a key with their concatenation
+    """
+    records = []
+    for line in content.splitlines():
+        if line.startswith(">"):
+            records.append([])
+        else:
+            if not records:
+                records.append([])
+            records[-1].append("".join(line.split()).upper())
+    sequence = ">".join("".join(record) for record in records)
+    return "{}:{}".format(hashlib.md5(sequence.encode()).hexdigest(), name)
+
+
+class ResultCache:
+    """ Keeps the hits of the most recently searched sequences in memory, least recently
+        used first. An entry stored for k hits answers any query for k or fewer
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, k):
+        """ Returns the best k hits stored for key, or None if the entry cannot answer
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_k, results = entry
+            if k > stored_k and len(results) >= stored_k:
+                return None
+            self.entries.move_to_end(key)
+            return results[:k]
+
+    def put(self, key, k, results):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > k:
+                self.entries.move_to_end(key)
+                return
+            self.entries[key] = (k, results)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+result_cache = ResultCache(result_cache_size)
+
+
+class TopHits:
+    """ Keeps the top_k highest scoring hits of one query in a min-heap, with at most
+        one hit per accession. Ties on score are broken by accession so the kept set
+        does not depend on the order blastn reports hits in
+    """
+
+    def __init__(self, top_k):
+        self.top_k = top_k
+        self.heap = []
+        self.best = {}
+
+    def add(self, metrics):
+        accession = metrics['accession']
+        key = (metrics['score'], invert(accession))
+        if accession in self.best:
+            # Keeps only the best scoring HSP of each accession
+            if metrics['score'] <= self.best[accession]['score']:
+                return
+            self.best[accession] = metrics
+            self.heap = [(m['score'], invert(a), a) for a, m in self.best.items()]
+            heapq.heapify(self.heap)
+        elif len(self.heap) < self.top_k:
+            self.best[accession] = metrics
+            heapq.heappush(self.heap, key + (accession,))
+        elif key > self.heap[0][:2]:
+            removed = heapq.heapreplace(self.heap, key + (accession,))
+            del self.best[removed[2]]
+            self.best[accession] = metrics
+
+    def results(self):
+        """ Returns the kept hits sorted by descending score """
+        return sorted(self.best.values(), key=lambda m: (-m['score'], m['accession']))
+
+
+def invert(accession):
+    """ Orders accessions in reverse so that, on equal score, the alphabetically
+        first accession ranks highest in the min-heap. The trailing 1 makes a prefix
+        rank above the longer accessions that start with it
+    """
+    return tuple(-ord(c) for c in accession) + (1,)
+
+
+def parse_hits(lines, top_hits):
+    """ Parses blastn tabular lines into the TopHits of the query they belong to """
+    for line in lines:
+        values = line.split("\t")
+        if values[0] not in top_hits or len(values) < 5:
+            continue
+        metrics = {}
+        metrics['accession'] = values[1]
+        metrics['score'] = int(values[2])
+        metrics['per_cov'] = float(values[3])
+        metrics['per_id'] = float(values[4])
+        top_hits[values[0]].add(metrics)
+
+
+def run_docker(container, jobs, answered):
+    """ This function runs the blast searches for a batch of queued queries in a warm docker
+        container, one blastn run per fragment the queries asked for. The id of every
+        job that was answered is added to answered
+    """
+    by_name = {}
+    for job in jobs:
+        by_name.setdefault(job[3], []).append(job)
+    for name, name_jobs in by_name.items():
+        run_blast(container, name, name_jobs, answered)
+
+
+def run_blast(container, name, jobs, answered):
+    """ This function runs one blast search of the fragment name for queued queries,
+        stream-parses its output by query id, and sends each query's top k results
+        with score, query coverage, and percent identity to the server that requested it.
+        The id of every job whose results were sent is added to answered
+    """
+    batch_id = "batch_{}".format(uuid.uuid4().hex)
+    fasta = "/blast/queries/{}.fsa".format(batch_id)
+    # Command to run, it limits results to:
+    # Query ID, Accession ID, Score, Query Coverage, and Identity Percentage
+    # of the best HSP of the best subjects, written to stdout. blastn keeps as many
+    # subjects as the query of the batch that asked for the most, and each query's
+    # TopHits trims its own hits to the number it asked for
+    cmnd = "timeout {} blastn -query {} -db {} -max_target_seqs {} -max_hsps 1 -outfmt \"6 qseqid sacc score qcovhsp pident\"".format(
+        tout, fasta, name, max(job[2] for job in jobs))
+
+    top_hits = {}
+    for qid, reply, k, name, content, trace in jobs:
+        # A query queued twice keeps as many hits as its largest request
+        if qid not in top_hits or top_hits[qid].top_k < k:
+            top_hits[qid] = TopHits(k)
+
+    # Parses stdout as it is produced, the stream ends as soon as blastn exits.
+    # The batch file is in memory, so it is deleted even if the search fails
+    start = time.monotonic()
+    api = container.client.api
+    try:
+        build_batch_fasta(jobs, batch_id)
+        exec_id = api.exec_create(container.id, cmnd)['Id']
+        partial = ""
+        errors = []
+        for stdout, stderr in api.exec_start(exec_id, stream=True, demux=True):
+            if stderr:
+                errors.append(stderr.decode())
+            if stdout:
+                lines = (partial + stdout.decode()).split("\n")
+                partial = lines.pop()
+                parse_hits(lines, top_hits)
+        parse_hits([partial], top_hits)
+        exit_code = api.exec_inspect(exec_id)['ExitCode']
+    finally:
+        try:
+            os.remove(os.path.join(query_dir, "{}.fsa".format(batch_id)))
+        except OSError:
+            pass
+    blastn_time = time.monotonic() - start
+    timeout_reached = exit_code != 0
+    if timeout_reached:
+        print("blastn failed for {} ({}): {}".format(batch_id, exit_code, "".join(errors)))
+
+    # Build json responses to server, one per query in the batch
+    for job in jobs:
+        qid, reply, k, name, content, trace = job
+        r_dict = {}
+        r_dict['qid'] = qid
+        r_dict['nid'] = nid
+        r_dict['db'] = name
+        r_dict['results'] = [] if timeout_reached else top_hits[qid].results()[:k]
+        if timeout_reached:
+            # The server searches the fragment elsewhere rather than take no hits as an answer
+            r_dict['error'] = "blastn exited with code {}".format(exit_code)
+        # Time spent waiting for a worker and in the blastn run, sent back to the server
+        r_dict['spans'] = [record_span(trace['id'], "queue_wait", start - trace['queued'], db=name),
+                           record_span(trace['id'], "blastn", blastn_time, db=name,
+                                       batch=len(jobs), exit_code=exit_code)]
+        if not timeout_reached:
+            result_cache.put(sequence_key(content, name), k, r_dict['results'])
+        # A server that cannot be reached does not keep the other queries from their results
+        answered.add(id(job))
+        try:
+            send_results(reply, r_dict)
+        except http_req.RequestException:
+            print(traceback.format_exc())
+
+
+def send_results(reply, r_dict):
+    """ Answers a query on the connection it arrived on if the server is waiting for it,
+        otherwise posts the results back to the server's /node_data endpoint
+    """
+    if isinstance(reply, Future):
+        # A query is answered once, later answers are dropped
+        if not reply.done():
+            reply.set_result(r_dict)
+        return
+    url = "http://{}:80/node_data/{}".format(reply, r_dict['qid'])
     http_req.post(url, json=r_dict)
 
 
+def next_batch():
+    """ Blocks for the next queued job, then gathers any jobs that arrive within
+        batch_window seconds, up to max_batch queries in total
+    """
+    jobs = [job_queue.get()]
+    deadline = time.monotonic() + batch_window
+    while len(jobs) < max_batch:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            jobs.append(job_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return jobs
+
+
+class BlastWorker(threading.Thread):
+    """ Owns one warm BLAST container and runs batches of queued searches in it until
+        the server exits. The container is restarted if it stops responding
+    """
+
+    def __init__(self, docker_client):
+        super().__init__(daemon=True)
+        self.docker_client = docker_client
+        self.container = start_container(docker_client)
+
+    def restart_container(self):
+        try:
+            self.container.remove(force=True)
+        except docker.errors.APIError:
+            pass
+        self.container = start_container(self.docker_client)
+
+    def run(self):
+        global active_jobs
+        while True:
+            jobs = next_batch()
+            with active_lock:
+                active_jobs += len(jobs)
+            answered = set()
+            try:
+                run_docker(self.container, jobs, answered)
+            except Exception as e:
+                print(traceback.format_exc())
+                # Answer the queries not answered yet with an error so the
+                # server does not wait on this node
+                for job in jobs:
+                    if id(job) in answered:
+                        continue
+                    qid, reply, k, name, content, trace = job
+                    try:
+                        send_results(reply, {'qid': qid, 'nid': nid, 'db': name, 'results': [],
+                                             'error': "BLAST worker failed"})
+                    except Exception:
+                        print(traceback.format_exc())
+                if isinstance(e, docker.errors.APIError):
+                    try:
+                        self.restart_container()
+                    except Exception:
+                        print(traceback.format_exc())
+            finally:
+                with active_lock:
+                    active_jobs -= len(jobs)
+                for job in jobs:
+                    job_queue.task_done()
+
+    def stop(self):
+        self.container.remove(force=True)
+
+
+def start_workers():
+    """ Starts pool_size BLAST workers and removes their containers on exit
+    """
+    os.makedirs(query_dir, exist_ok=True)
+    docker_client = docker.from_env()
+    for i in range(pool_size):
+        worker = BlastWorker(docker_client)
+        worker.start()
+        workers.append(worker)
+    atexit.register(stop_workers)
+
+
+def stop_workers():
+    for worker in workers:
+        try:
+            worker.stop()
+        except docker.errors.APIError:
+            pass
+
+
+def node_load():
+    """ Returns the current load of this node: searches running, queries waiting,
+        and whether new requests would be refused
+    """
+    queued = job_queue.qsize()
+    return {'status': "nice and healthy",
+            'nid': nid,
+            'dbs': dbs,
+            'pool_size': pool_size,
+            'active': active_jobs,
+            'queued': queued,
+            'max_pending': max_pending,
+            'busy': queued >= max_pending}
+
+
 @app.route('/status')
 def healthy():
-    return "nice and healthy", 200
+    return jsonify(node_load()), 200
+
+
+@app.route('/metrics')
+def metrics():
+    """ Count and total seconds of every span in the Prometheus text format
+    """
+    lines = ["# TYPE genbanklink_db_span_seconds summary"]
+    with trace_lock:
+        for (name, db_name), (count, total) in sorted(span_totals.items()):
+            labels = 'span="{}",db="{}",nid="{}"'.format(name, db_name, nid)
+            lines.append("genbanklink_db_span_seconds_count{{{}}} {}".format(labels, count))
+            lines.append("genbanklink_db_span_seconds_sum{{{}}} {}".format(labels, total))
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/debug/trace/<trace_id>')
+def debug_trace(trace_id):
+    """ Spans this node recorded for a trace id, which is the query id
+    """
+    with trace_lock:
+        spans = list(traces.get(trace_id, []))
+    if not spans:
+        return jsonify({'trace_id': trace_id, 'status': "No trace for this query"}), 404
+    return jsonify({'trace_id': trace_id, 'nid': nid, 'spans': spans}), 200
+
+
+def cached_answer(qid, name, content, k, trace):
+    """ Returns the answer to a query if the sequence was searched in the fragment
+        name before, otherwise None
+    """
+    results = result_cache.get(sequence_key(content, name), k)
+    if results is None:
+        return None
+    return {'qid': qid, 'nid': nid, 'db': name, 'results': results,
+            'spans': [record_span(trace['id'], "cache_hit", 0.0, db=name)]}
 
 
 @app.route('/api/request/<qid>', methods=['POST', 'GET'])
 def process_request(qid):
     ''' 
-    Receives query requests from server, spins up thread and runs
-    docker command in thread
+    Receives query requests from server and queues them for the
+    BLAST worker pool. With ?wait=1 the results are returned as the
+    response, a 502 if the search failed, otherwise they are posted back
+    to the server with an "error" field if it failed. ?top_k=N
+    sets how many best hits are returned, up to max_top_k, and ?db=name
+    the fragment to search, one of dbs
     '''
     print("Got request for: {}".format(qid))
+    # The server's trace id for the query, its qid unless the header says otherwise
+    trace = {'id': request.headers.get('X-Trace-Id', qid), 'queued': time.monotonic()}
+    name = request.args.get('db', dbs[0])
+    if name not in dbs:
+        return jsonify({'status': "Fragment {} is not on this node".format(name), 'dbs': dbs}), 404
     content = request.data.decode('UTF-8')
-    fasta = os.path.join(HOME, "queries", "{}.fsa".format(qid))
-    with open(fasta, "w+") as fast_f:
-        fast_f.write(content)
-    remote_ip = request.remote_addr
-    thread = threading.Thread(target=run_docker, args=(qid,remote_ip))
-    thread.start()
+    reply = Future() if request.args.get('wait') else request.remote_addr
+    k = min(max(request.args.get('top_k', top_k, type=int), 1), max_top_k)
+    # Answers at once if the sequence was searched in this fragment before
+    r_dict = cached_answer(qid, name, content, k, trace)
+    if r_dict is not None:
+        if isinstance(reply, Future):
+            return jsonify(r_dict), 200
+        threading.Thread(target=send_results, args=(reply, r_dict), daemon=True).start()
+        return "ok", 200
+    try:
+        job_queue.put_nowait((qid, reply, k, name, content, trace))
+    except queue.Full:
+        # Node is saturated, the server should retry once load drops
+        return jsonify(node_load()), 503
+    if isinstance(reply, Future):
+        r_dict = reply.result()
+        return jsonify(r_dict), 502 if 'error' in r_dict else 200
     return "ok", 200
 
 
+@app.route('/api/batch', methods=['POST'])
+def process_batch():
+    '''
+    Receives several queries for one fragment, ?db=name, as JSON
+    {"queries": [{"qid", "sequence", "top_k"}, ...]} and queues them together,
+    so the BLAST workers search them in shared blastn runs. Answers once all
+    are done with {"nid", "db", "answers", "refused", "failed"}: the results of
+    each query searched, the qids that did not fit in the queue, and those
+    whose search failed
+    '''
+    name = request.args.get('db', dbs[0])
+    if name not in dbs:
+        return jsonify({'status': "Fragment {} is not on this node".format(name), 'dbs': dbs}), 404
+    queries = (request.get_json(force=True, silent=True) or {}).get('queries') or []
+    print("Got batch of {} queries".format(len(queries)))
+    answers = []
+    replies = []
+    refused = []
+    for query in queries:
+        qid = query['qid']
+        content = query['sequence']
+        trace = {'id': qid, 'queued': time.monotonic()}
+        k = min(max(int(query.get('top_k') or top_k), 1), max_top_k)
+        r_dict = cached_answer(qid, name, content, k, trace)
+        if r_dict is not None:
+            answers.append(r_dict)
+            continue
+        reply = Future()
+        try:
+            job_queue.put_nowait((qid, reply, k, name, content, trace))
+        except queue.Full:
+            refused.append(qid)
+            continue
+        replies.append(reply)
+    if queries and len(refused) == len(queries):
+        # Node is saturated, the server should retry once load drops
+        return jsonify(node_load()), 503
+    failed = []
+    for reply in replies:
+        r_dict = reply.result()
+        if 'error' in r_dict:
+            failed.append(r_dict['qid'])
+        else:
+            answers.append(r_dict)
+    return jsonify({'nid': nid, 'db': name, 'answers': answers, 'refused': refused, 'failed': failed}), 200
+
+
 def main():
-    app.run(host='0.0.0.0',port=80, debug=True)
+    start_workers()
+    # The reloader would start a second worker pool in its parent process
+    app.run(host='0.0.0.0',port=80, debug=True, use_reloader=False, threaded=True)
 
 
 if __name__ == "__main__":
@@ -1,10 +1,15 @@
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 import os
 import requests as http_req
 import hashlib
 import copy
 import json
 import traceback
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from requests.adapters import HTTPAdapter
 from flask_cors import CORS
 
 app = Flask(__name__)
@@ -17,6 +22,51 @@ with open("CommIP.txt", "r") as f:
 comm_ip=comm_ip.strip()
 commNode_url = f"http://{comm_ip}/"
 
+# Number of best BLAST results shown for a part. Can be changed per plugin
+# by registering the run endpoint with ?top_k=N in SynBioHub
+default_top_k = 10
+
+# Most /run calls whose FASTA fetch and query are in flight at once. Calls
+# beyond it wait up to run_queue_timeout seconds for a slot, then get the
+# error page instead of tying up a server thread
+max_runs = 16
+run_queue_timeout = 2
+# Seconds a /run call waits for a slot, the FASTA fetch and the query together,
+# and the connect and read timeouts of each of those requests
+run_timeout = 10
+request_timeout = (3.05, 10)
+
+def pooled_session():
+    # Session keeping up to max_runs connections alive per host
+    session = http_req.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_runs)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# Keep-alive connection pools to SynBioHub and the Communication Server,
+# shared by every /run call
+synbiohub_session = pooled_session()
+comm_session = pooled_session()
+
+# Runs the upstream requests of /run calls, at most max_runs at a time. A slot
+# is freed when its requests finish, even if the call stopped waiting for them
+run_executor = ThreadPoolExecutor(max_workers=max_runs)
+run_slots = threading.BoundedSemaphore(max_runs)
+
+# FASTA files of a bulk request fetched at once, seconds between its checks on
+# the Communication Server, and seconds its results stream stays open
+bulk_fetches = 8
+bulk_poll_interval = 2
+bulk_timeout = 3600
+bulk_executor = ThreadPoolExecutor(max_workers=bulk_fetches)
+
+# Loads the pages once, the results page compiled as a Jinja template
+with open(os.path.join(os.getcwd(), "html/index.html"), "r") as htmlfile:
+    index_template = app.jinja_env.from_string(htmlfile.read())
+with open(os.path.join(os.getcwd(), "html/error.html"), "r") as htmlfile:
+    error_page = htmlfile.read()
+
 @app.route("/status")
 def status():
     return("The Visualisation Test Plugin Flask Server is up and running")
@@ -52,43 +102,152 @@ def run():
     size = data['size']
     rdf_type = data['type']
     shallow_sbol = data['shallow_sbol']
+    top_k = request.args.get('top_k', default_top_k, type=int)
     
     url = complete_sbol.replace('/sbol','')
     
+    # Id sent with the request, so the Communication Server's trace of
+    # the query can be matched with this log
+    trace_id = uuid.uuid4().hex
+    # Waits briefly for a slot, and sheds the call if too many are still
+    # waiting on SynBioHub or the server
+    start = time.monotonic()
+    if not run_slots.acquire(timeout=run_queue_timeout):
+        print(f"Trace {trace_id}: {max_runs} runs in flight after {run_queue_timeout}s, returning the error page")
+        return error_page, 299
     # Try Except prevents errors from affecting main page
     try:
-        cwd = os.getcwd()
-        # Gets the fasta file for the current page
-        resp=http_req.get(url+r'/fasta', timeout=10)
-        fasta_file = resp.content
-        # Sends fasta file data to Communication Server, and stores response
-        header = {'Content-Type':'text/plain'}
-        response = http_req.post(commNode_url+"plugin_request", fasta_file, headers=header, timeout=10)
-        resp_content = response.json()
+        future = run_executor.submit(send_query, url, top_k, trace_id)
+    except Exception:
+        run_slots.release()
+        raise
+    future.add_done_callback(lambda future: run_slots.release())
+    try:
+        resp_content = future.result(timeout=run_timeout - (time.monotonic() - start))
 
         # If the file was sent successfully, render the plugin's html
         # page and send the data to the page
         if resp_content["status"] == "success":
-            qid = response.json()['qid']
-            filename = os.path.join(cwd, "html/index.html")
-            with open(filename, 'r') as htmlfile:
-                result = htmlfile.read()
-            result = result.replace("COMM_NODE_IP", commNode_url)
-            result = result.replace("QUERY_ID", qid)
+            return index_template.render(comm_node_url=commNode_url, query_id=resp_content['qid'])
         # Otherwise, load the error page
         else:
-            with open(os.path.join(cwd, "html/error.html"), 'r') as htmlfile:
-                result = htmlfile.read()
-                print(resp_content["status"])
-        return result
+            print(resp_content["status"])
+            return error_page
+    except FutureTimeout:
+        print(f"Trace {trace_id}: no answer after {run_timeout}s")
+        return error_page, 299
     # If an exception occurs, load the error page and print to
     # the server console the exception's traceback
     except Exception as e:
-        with open(os.path.join(cwd, "html/error.html"), 'r') as htmlfile:
-            result = htmlfile.read()
         print(traceback.format_exc())
-        return result, 299
+        return error_page, 299
+
+
+def send_query(url, top_k, trace_id):
+    # Fetches the FASTA file of the part at url and sends it to the Communication
+    # Server. Returns the server's response
+    start = time.monotonic()
+    resp = synbiohub_session.get(url+r'/fasta', timeout=request_timeout)
+    fasta_file = resp.content
+    fetched = time.monotonic()
+    # Sends fasta file data to Communication Server, and stores response
+    header = {'Content-Type':'text/plain', 'X-Trace-Id': trace_id}
+    response = comm_session.post(commNode_url+"plugin_request", fasta_file, headers=header,
+                                 params={'top_k': top_k}, timeout=request_timeout)
+    resp_content = response.json()
+    print(f"Trace {trace_id}: fasta fetch {fetched - start:.3f}s, "
+          f"plugin_request {time.monotonic() - fetched:.3f}s, qid {resp_content.get('qid')}")
+    return resp_content
+
+
+def fetch_fasta(uri):
+    # Fetches the FASTA file of a SynBioHub component or collection
+    resp = synbiohub_session.get(uri.replace('/sbol','')+r'/fasta', timeout=request_timeout)
+    resp.raise_for_status()
+    return resp.text
+
+
+def split_fasta(fasta):
+    # Splits a FASTA file with several records into a list of (name, record)
+    records = []
+    for line in fasta.splitlines():
+        if line.startswith(">"):
+            name = line[1:].split()
+            records.append((name[0] if name else str(len(records)), [line]))
+        elif records:
+            records[-1][1].append(line)
+    return [(name, "\n".join(lines) + "\n") for name, lines in records]
+
+
+@app.route("/run_bulk", methods=["POST"])
+def run_bulk():
+    # Annotates many components at once, e.g. to fill the result cache for a new
+    # collection. Takes JSON with either "collection", the URI of a SynBioHub
+    # collection, or "complete_sbol", a list of component URIs. Their FASTA files
+    # are fetched concurrently and sent to the Communication Server in one request,
+    # then each component's results are streamed back as a JSON line as soon as
+    # they are ready. ?top_k=N asks for the N best results of each
+    data = request.get_json(force=True)
+    top_k = request.args.get('top_k', default_top_k, type=int)
+    sequences = []
+    failed = []
+    if data.get('collection'):
+        try:
+            # A collection's FASTA file holds one record per member
+            sequences = [{"id": name, "fasta": record}
+                         for name, record in split_fasta(fetch_fasta(data['collection']))]
+        except Exception:
+            print(traceback.format_exc())
+            return jsonify({"status": "Could not fetch the collection's FASTA file"}), 502
+    else:
+        uris = list(dict.fromkeys(data.get('complete_sbol') or []))
+        futures = [bulk_executor.submit(fetch_fasta, uri) for uri in uris]
+        for uri, future in zip(uris, futures):
+            try:
+                sequences.append({"id": uri, "fasta": future.result()})
+            except Exception:
+                print(traceback.format_exc())
+                failed.append({"id": uri, "status": "Could not fetch the FASTA file"})
+
+    try:
+        response = comm_session.post(commNode_url+"plugin_request_batch", json={"sequences": sequences},
+                                     params={'top_k': top_k}, timeout=(3.05, 60))
+        resp_content = response.json()
+    except Exception:
+        print(traceback.format_exc())
+        return jsonify({"status": "Could not reach the Communication Server"}), 502
+    if not isinstance(resp_content, dict):
+        return jsonify({"status": "Unexpected answer from the Communication Server"}), 502
+    if resp_content.get("status") != "success":
+        return jsonify(resp_content), response.status_code
+    # Components with the same sequence share a query
+    pending = {}
+    for query in resp_content["queries"]:
+        pending.setdefault(query["qid"], []).append(query["id"])
+    print(f"Bulk request for {len(sequences)} components, {len(pending)} queries")
+
+    def stream():
+        for entry in failed:
+            yield json.dumps(entry) + "\n"
+        deadline = time.monotonic() + bulk_timeout
+        while pending and time.monotonic() < deadline:
+            try:
+                states = comm_session.post(commNode_url+"plugin_poll_batch", json={"qids": list(pending)},
+                                           timeout=request_timeout).json()["states"]
+            except Exception:
+                print(traceback.format_exc())
+                states = {}
+            for qid, payload in states.items():
+                if payload["State"] in ("Done", "Query not found") and qid in pending:
+                    for id in pending.pop(qid):
+                        yield json.dumps({"id": id, "qid": qid, "status": payload["State"], "results": payload}) + "\n"
+            if pending:
+                time.sleep(bulk_poll_interval)
+        for qid, ids in pending.items():
+            for id in ids:
+                yield json.dumps({"id": id, "qid": qid, "status": "Timed out"}) + "\n"
 
+    return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
 
 
 if __name__ == "__main__":
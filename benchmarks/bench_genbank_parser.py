@@ -0,0 +1,108 @@
+"""Benchmark for parsing large multi-record efetch GenBank payloads.
+
+Compares the streaming header parser used by get_full_gb_info with the
+previous approach, which split the decoded payload on "//" and ran nine
+regexes, compiled inside the loop, over the full text of every record.
+
+Run from the repository root:
+    python benchmarks/bench_genbank_parser.py
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CommunicationServer"))
+
+from genbank_parser import parse_genbank_headers  # noqa: E402
+
+RECORD_COUNTS = [10, 100, 500]
+SEQUENCE_LENGTH = 20000
+REFERENCES = 5
+
+
+def make_record(i, rng):
+    # Builds a synthetic GenBank flat file record with REFERENCES references,
+    # a short feature table and a SEQUENCE_LENGTH base sequence
+    lines = [f"LOCUS       SYN{i:06d}               {SEQUENCE_LENGTH} bp    DNA     linear   SYN 01-JAN-2021",
+             f"DEFINITION  Synthetic construct {i} used to benchmark the GenBank header",
+             "            parser, complete sequence.",
+             f"ACCESSION   SYN{i:06d}",
+             f"VERSION     SYN{i:06d}.1",
+             "KEYWORDS    .",
+             "SOURCE      synthetic construct",
+             "  ORGANISM  synthetic construct",
+             "            other sequences; artificial sequences."]
+    for ref in range(1, REFERENCES + 1):
+        lines += [f"REFERENCE   {ref}  (bases 1 to {SEQUENCE_LENGTH})",
+                  "  AUTHORS   Doe,J., Roe,R., Smith,A., Jones,B., Brown,C., Miller,D.,",
+                  "            Davis,E. and Wilson,F.",
+                  f"  TITLE     Reference {ref} of construct {i} with a title long enough to",
+                  "            wrap onto a second line",
+                  f"  JOURNAL   J. Synth. Biol. {ref} (1), 1-10 (2021)",
+                  f"   PUBMED   {30000000 + i * 10 + ref}"]
+    lines += ["FEATURES             Location/Qualifiers",
+              f"     source          1..{SEQUENCE_LENGTH}",
+              "                     /organism=\"synthetic construct\"",
+              "ORIGIN      "]
+    sequence = "".join(rng.choice("acgt") for _ in range(SEQUENCE_LENGTH))
+    for start in range(0, SEQUENCE_LENGTH, 60):
+        chunk = sequence[start:start + 60]
+        blocks = " ".join(chunk[j:j + 10] for j in range(0, len(chunk), 10))
+        lines.append(f"{start + 1:>9} {blocks}")
+    lines.append("//")
+    return "\n".join(lines) + "\n"
+
+
+def regex_parse(payload, accession_id_list):
+    # The previous per-record regex parsing, kept here as the baseline
+    gb_file_list = payload.decode().split("//\n")
+    if '\n' in gb_file_list:
+        gb_file_list.remove('\n')
+    result = {}
+    for i, gb_file in enumerate(gb_file_list):
+        if not gb_file.strip():
+            continue
+        patterns = [
+            re.compile(r'(?<=^LOCUS\s{7})([\S]+?)(?=\s+)', re.MULTILINE),
+            re.compile(r'(?<=^DEFINITION\s{2})([\s\S]+?)(?=\n[A-Z]{2,})', re.MULTILINE),
+            re.compile(r'(?<=^SOURCE\s{6})([\s\S]+?)(?=\n\s*[A-Z]{2,})', re.MULTILINE),
+            re.compile(r'(?<=REFERENCE\s{3})([0-9].*)(?=\n)$', re.MULTILINE),
+            re.compile(r'(?<=\s{2}AUTHORS\s{3})([\s\S]+?)(?=\s{3}[A-Z]{2,})', re.MULTILINE),
+            re.compile(r'(?<=\s{2}CONSRTM\s{3})([\s\S]+?)(?=\s{3}[A-Z]{2,})', re.MULTILINE),
+            re.compile(r'(?<=\s{2}TITLE\s{5})([\s\S]+?)(?=\s{3}[A-Z]{2,})', re.MULTILINE),
+            re.compile(r'(?<=\s{2}JOURNAL\s{3})([\s\S]+?)(?=\n\s{0,4}[A-Z]{2,})', re.MULTILINE),
+            re.compile(r'(?<=PUBMED\s{3})([\w\d]+)(?=\n)$', re.MULTILINE)]
+        result[accession_id_list[i]] = [re.search(pattern, gb_file) for pattern in patterns]
+    return result
+
+
+def streaming_parse(payload, accession_id_list):
+    lines = (line.decode() for line in payload.splitlines(keepends=True))
+    return {record["VERSION"]: record for record in parse_genbank_headers(lines)}
+
+
+def best_of(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    rng = random.Random(0)
+    print(f"{'records':>8} {'payload MB':>11} {'regex (ms)':>11} {'streaming (ms)':>15}")
+    for count in RECORD_COUNTS:
+        payload = "".join(make_record(i, rng) for i in range(count)).encode() + b"\n"
+        accession_id_list = [f"SYN{i:06d}.1" for i in range(count)]
+        regex_time = best_of(regex_parse, payload, accession_id_list)
+        streaming_time = best_of(streaming_parse, payload, accession_id_list)
+        print(f"{count:>8} {len(payload) / 2**20:>11.1f} {regex_time * 1000:>11.1f} {streaming_time * 1000:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Microbenchmark for the communication server's QueryTracker.
+
+Measures the average cost of new, status and store_results while the
+pending queue grows to thousands of entries. Every column should stay
+flat as the queue size grows.
+
+Run from the repository root:
+    python benchmarks/bench_query_tracker.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CommunicationServer"))
+
+from query_tracker import QueryTracker  # noqa: E402
+
+MAX_ACTIVE = 5
+NODE_COUNT = 8
+QUEUE_SIZES = [10, 100, 1000, 5000, 20000]
+REPEAT = 2000
+
+
+def filled_tracker(queue_size):
+    # Builds a tracker with every active slot used and queue_size pending queries
+    qtrack = QueryTracker(MAX_ACTIVE)
+    for i in range(MAX_ACTIVE + queue_size):
+        qtrack.new(f"q{i}", "ACGT", NODE_COUNT)
+    return qtrack
+
+
+def bench_new(queue_size):
+    qtrack = filled_tracker(queue_size)
+    ids = iter(range(REPEAT))
+    return timeit.timeit(lambda: qtrack.new(f"n{next(ids)}", "ACGT", NODE_COUNT), number=REPEAT)
+
+
+def bench_status(queue_size):
+    qtrack = filled_tracker(queue_size)
+    # Looks up the last queued query, the worst case for a linear scan
+    last = f"q{MAX_ACTIVE + queue_size - 1}"
+    return timeit.timeit(lambda: qtrack.status(last), number=REPEAT)
+
+
+def bench_store_results(queue_size):
+    qtrack = filled_tracker(queue_size)
+    nids = iter(range(REPEAT))
+    active = f"q{MAX_ACTIVE - 1}"
+    return timeit.timeit(lambda: qtrack.store_results(active, next(nids), []), number=REPEAT)
+
+
+def main():
+    print(f"{'queue size':>10} {'new (us)':>10} {'status (us)':>12} {'store (us)':>11}")
+    for queue_size in QUEUE_SIZES:
+        timings = [bench(queue_size) / REPEAT * 1e6
+                   for bench in (bench_new, bench_status, bench_store_results)]
+        print(f"{queue_size:>10} {timings[0]:>10.2f} {timings[1]:>12.2f} {timings[2]:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Stand-in for a database node that answers queries with synthetic BLAST hits.
+
+Implements the parts of DatabaseServer/db_server.py the communication server
+talks to: GET /status with the node's load, and POST /api/request/<qid>?wait=1
+answered with {qid, nid, db, results, spans}. Each answer takes a latency drawn
+from a configurable distribution, and a configurable fraction of requests fail
+with a 500 or are refused with a 503 as a saturated node would. Hits are derived
+from the query and fragment, so the same query always gets the same hits, and
+their accessions are ones the stub E-utilities server knows.
+
+Used by load_driver.py, or run on its own from the repository root:
+    python benchmarks/fake_db_node.py --port 9001 --dbs nt.00,nt.01 --latency lognormal:2,0.5
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Number of distinct accessions hits are drawn from
+ACCESSION_POOL = 5000
+
+
+def accession(i):
+    # Accessions are reported without a version, as blastn reports them
+    return f"SYN{i:06d}"
+
+
+def parse_latency(spec):
+    # Turns a latency spec into a function returning a delay in seconds:
+    #   fixed:S            always S seconds
+    #   uniform:A,B        between A and B seconds
+    #   lognormal:M,SIGMA  log-normal with median M seconds, a long tail as SIGMA grows
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",")] if args else []
+    if kind == "fixed":
+        return lambda rng: values[0]
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda rng: median * rng.lognormvariate(0, sigma)
+    raise ValueError(f"Unknown latency distribution {spec}")
+
+
+class FakeDBNode:
+    # This class serves one fake database node on its own thread. dbs are the
+    # fragments it holds, the first being searched when a request names none
+    def __init__(self, port, nid, dbs, latency="fixed:0.5", failure_rate=0.0, busy_rate=0.0,
+                 max_pending=50, seed=0, host="127.0.0.1"):
+        self.nid = nid
+        self.dbs = dbs
+        self.latency = parse_latency(latency)
+        self.failure_rate = failure_rate
+        self.busy_rate = busy_rate
+        self.max_pending = max_pending
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.served = 0
+        self.failed = 0
+        self.refused = 0
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def address(self):
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def load(self):
+        return {"status": "nice and healthy", "nid": self.nid, "dbs": self.dbs, "pool_size": 1,
+                "active": self.active, "queued": 0, "max_pending": self.max_pending,
+                "busy": self.active >= self.max_pending}
+
+    def stats(self):
+        return {"served": self.served, "failed": self.failed, "refused": self.refused}
+
+    def hits(self, sequence, name, k):
+        # Draws k hits from the accession pool, seeded by the sequence and fragment
+        seed = hashlib.md5(f"{name}:{sequence}".encode()).hexdigest()
+        rng = random.Random(seed)
+        results = []
+        for i in rng.sample(range(ACCESSION_POOL), k):
+            results.append({"accession": accession(i), "score": rng.randint(50, 2000),
+                            "per_cov": float(rng.randint(20, 100)),
+                            "per_id": round(rng.uniform(70, 100), 3)})
+        results.sort(key=lambda result: -result["score"])
+        return results
+
+    def answer(self, qid, name, sequence, k):
+        # Returns the status code and body for a query, after its latency
+        with self.lock:
+            roll = self.rng.random()
+            delay = self.latency(self.rng)
+            if roll < self.busy_rate or self.active >= self.max_pending:
+                self.refused += 1
+                return 503, self.load()
+            self.active += 1
+        try:
+            time.sleep(delay)
+            if roll < self.busy_rate + self.failure_rate:
+                with self.lock:
+                    self.failed += 1
+                return 500, {"status": "BLAST failed"}
+            with self.lock:
+                self.served += 1
+            return 200, {"qid": qid, "nid": self.nid, "db": name, "results": self.hits(sequence, name, k),
+                         "spans": [{"name": "blastn", "duration": delay, "db": name}]}
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def _handler(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The server dropped a hedged request another replica answered first
+                    pass
+
+            def do_GET(self):
+                if urlparse(self.path).path == "/status":
+                    self.send_json(200, node.load())
+                else:
+                    self.send_json(404, {"status": "Not found"})
+
+            def do_POST(self):
+                url = urlparse(self.path)
+                args = {key: values[0] for key, values in parse_qs(url.query).items()}
+                sequence = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                if not url.path.startswith("/api/request/"):
+                    return self.send_json(404, {"status": "Not found"})
+                if "wait" not in args:
+                    # Results posted back to the server are not simulated
+                    return self.send_json(400, {"status": "Only ?wait=1 requests are supported"})
+                name = args.get("db", node.dbs[0])
+                if name not in node.dbs:
+                    return self.send_json(404, {"status": f"Fragment {name} is not on this node", "dbs": node.dbs})
+                k = min(max(int(args.get("top_k", 10)), 1), 500)
+                self.send_json(*node.answer(url.path.rsplit("/", 1)[1], name, sequence, k))
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--nid", default="fake-1")
+    parser.add_argument("--dbs", default="nt", help="comma separated fragments the node holds")
+    parser.add_argument("--latency", default="lognormal:1,0.5",
+                        help="fixed:S, uniform:A,B or lognormal:MEDIAN,SIGMA seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--busy-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    node = FakeDBNode(args.port, args.nid, args.dbs.split(","), args.latency, args.failure_rate,
+                      args.busy_rate, seed=args.seed, host=args.host).start()
+    print(f"Fake database node {args.nid} serving {args.dbs} on {node.address}")
+    try:
+        node.thread.join()
+    except KeyboardInterrupt:
+        node.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""End-to-end load test of the plugin, communication and database servers, offline.
+
+Starts fake database nodes (fake_db_node.py) holding the fragments of a shard
+map, the stub E-utilities (stub_eutils.py) and a stand-in for SynBioHub serving
+the FASTA of synthetic parts. Unless --plugin and --comm point at servers that
+are already running, it also launches the communication and plugin servers in a
+temporary directory, configured to use the stand-ins. It then replays --requests
+plugin /run calls, --concurrency at a time, polls each query until it is done
+and reports throughput, p50/p95/p99 end-to-end latency, and the latency of each
+stage: the /run call, the wait for results, and the spans the communication
+server traced for the query (fragment fan-out, fan-in, BLAST on the nodes,
+E-utilities calls, GenBank processing).
+
+Run from the repository root, with the servers' requirements installed:
+    python benchmarks/load_driver.py --requests 200 --concurrency 20 \\
+        --nodes 4 --fragments 4 --replicas 2 --latency lognormal:1,0.5 --failure-rate 0.02
+
+--json writes the report for comparison between runs, and --fail-above-p95
+exits with status 1 when the p95 latency is over the given seconds, so the
+harness can gate performance regressions.
+"""
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_db_node import FakeDBNode  # noqa: E402
+from stub_eutils import StubEutils  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HOST = "127.0.0.1"
+
+
+def percentile(values, p):
+    # Nearest-rank percentile, None for no values
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def http(method, url, body=None, headers=None, timeout=60):
+    # Returns the status code and body of a request, errors included
+    request = urllib.request.Request(url, data=body, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+class SynBioHubStub:
+    # This class serves the FASTA of synthetic parts at /parts/<i>/fasta, the
+    # only SynBioHub call the plugin server makes
+    def __init__(self, sequences):
+        self.sequences = sequences
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                match = re.fullmatch(r"/parts/(\d+)/fasta", self.path)
+                if match is None or int(match.group(1)) >= len(stub.sequences):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = f">part_{match.group(1)}\n{stub.sequences[int(match.group(1))]}\n".encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((HOST, 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://{HOST}:{self.server.server_address[1]}/"
+
+    def run_request(self, i):
+        # Body of the plugin /run call SynBioHub would make for part i
+        part = f"{self.url}parts/{i}"
+        return {"top_level": part, "complete_sbol": part + "/sbol", "shallow_sbol": part + "/sbol",
+                "instanceUrl": self.url, "size": 1, "type": "Component"}
+
+
+def start_nodes(args):
+    # Starts the fake nodes and returns them with the shard map placing each
+    # fragment on --replicas consecutive nodes
+    fragments = [f"nt.{i:02d}" for i in range(args.fragments)]
+    placement = {fragment: [(i + r) % args.nodes for r in range(min(args.replicas, args.nodes))]
+                 for i, fragment in enumerate(fragments)}
+    nodes = []
+    for n in range(args.nodes):
+        dbs = [fragment for fragment, holders in placement.items() if n in holders]
+        nodes.append(FakeDBNode(0, f"fake-{n}", dbs or ["nt"], args.latency, args.failure_rate,
+                                args.busy_rate, seed=args.seed + n, host=HOST).start())
+    shard_map = {fragment: [nodes[n].address for n in holders] for fragment, holders in placement.items()}
+    return nodes, shard_map
+
+
+def wait_until_up(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server for {url} exited with status {process.returncode}")
+        try:
+            if http("GET", url + "status", timeout=2)[0] == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"Server for {url} did not start")
+
+
+def launch_servers(workdir, shard_map, eutils_url):
+    # Runs the communication and plugin servers in workdir, each with its config
+    # files, and returns their processes and URLs
+    comm_dir = os.path.join(workdir, "comm")
+    plugin_dir = os.path.join(workdir, "plugin")
+    os.makedirs(comm_dir)
+    os.makedirs(plugin_dir)
+    with open(os.path.join(comm_dir, "Entrez_User_Info.json"), "w") as f:
+        f.write(json.dumps({"api_key": "benchmark", "email": "benchmark@example.com"}))
+    with open(os.path.join(comm_dir, "DBIPs.txt"), "w") as f:
+        f.write("\n".join(dict.fromkeys(ip for ips in shard_map.values() for ip in ips)))
+    with open(os.path.join(comm_dir, "shard_map.json"), "w") as f:
+        f.write(json.dumps(shard_map))
+    comm_port = free_port()
+    with open(os.path.join(plugin_dir, "CommIP.txt"), "w") as f:
+        f.write(f"{HOST}:{comm_port}")
+    shutil.copytree(os.path.join(ROOT, "PluginServer", "html"), os.path.join(plugin_dir, "html"))
+    plugin_port = free_port()
+
+    env = dict(os.environ, COMM_EUTILS_URL=eutils_url,
+               COMM_SHARD_MAP=os.path.join(comm_dir, "shard_map.json"),
+               COMM_STATE_DB=os.path.join(comm_dir, "state.db"),
+               COMM_ENTREZ_DB=os.path.join(comm_dir, "entrez.db"),
+               COMM_SEQUENCE_INDEX=os.path.join(comm_dir, "sequences.db"))
+    processes = []
+    for name, directory, port in (("comm_server", comm_dir, comm_port), ("plugin_server", plugin_dir, plugin_port)):
+        source = "CommunicationServer" if name == "comm_server" else "PluginServer"
+        command = [sys.executable, "-c",
+                   f"import {name}; {name}.app.run(host='{HOST}', port={port}, threaded=True)"]
+        log = open(os.path.join(workdir, name + ".log"), "w")
+        processes.append(subprocess.Popen(command, cwd=directory, stdout=log, stderr=subprocess.STDOUT,
+                                          env=dict(env, PYTHONPATH=os.path.join(ROOT, source))))
+    comm_url = f"http://{HOST}:{comm_port}/"
+    plugin_url = f"http://{HOST}:{plugin_port}/"
+    wait_until_up(comm_url, processes[0])
+    wait_until_up(plugin_url, processes[1])
+    return processes, comm_url, plugin_url
+
+
+def run_query(args, synbiohub, comm_url, plugin_url, part):
+    # Makes one plugin /run call and polls its query until the results are ready.
+    # Returns the query's timings, or its error
+    start = time.monotonic()
+    status, body = http("POST", f"{plugin_url}run?top_k={args.top_k}",
+                        json.dumps(synbiohub.run_request(part)).encode(), {"Content-Type": "application/json"})
+    ran = time.monotonic()
+    match = re.search(rb"var query_id = '([^']*)'", body)
+    if status != 200 or match is None:
+        return {"error": f"/run answered {status}"}
+    qid = match.group(1).decode()
+    deadline = ran + args.query_timeout
+    while time.monotonic() < deadline:
+        status, body = http("GET", f"{comm_url}plugin_poll/{qid}")
+        if status == 200:
+            break
+        if status == 220:
+            return {"error": "query not found", "qid": qid}
+        time.sleep(args.poll_interval)
+    else:
+        return {"error": "timed out", "qid": qid}
+    done = time.monotonic()
+    return {"qid": qid, "latency": done - start, "stages": {"run": ran - start, "wait": done - ran},
+            "missing": bool(json.loads(body).get("missing"))}
+
+
+def traced_stages(comm_url, qid):
+    # Sums the duration of each span name the communication server traced for a query
+    status, body = http("GET", f"{comm_url}debug/trace/{qid}")
+    stages = {}
+    if status == 200:
+        for span in json.loads(body)["spans"]:
+            if span.get("duration"):
+                stages[span["name"]] = stages.get(span["name"], 0) + span["duration"]
+    return stages
+
+
+def report(args, results, elapsed):
+    done = [result for result in results if "latency" in result]
+    latencies = [result["latency"] for result in done]
+    stages = {}
+    for result in done:
+        for name, duration in result["stages"].items():
+            stages.setdefault(name, []).append(duration)
+    errors = {}
+    for result in results:
+        if "error" in result:
+            errors[result["error"]] = errors.get(result["error"], 0) + 1
+    return {"requests": len(results), "completed": len(done), "errors": errors,
+            "incomplete_results": sum(result["missing"] for result in done),
+            "elapsed": elapsed, "throughput": len(done) / elapsed if elapsed else 0,
+            "latency": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+            "stages": {name: {"mean": sum(values) / len(values), "p95": percentile(values, 95),
+                              "queries": len(values)} for name, values in sorted(stages.items())},
+            "config": {key: value for key, value in vars(args).items() if key != "json"}}
+
+
+def print_report(result, nodes, eutils):
+    def seconds(value):
+        return "-" if value is None else f"{value:8.3f}s"
+
+    print(f"{result['completed']}/{result['requests']} queries in {result['elapsed']:.1f}s, "
+          f"{result['throughput']:.2f} queries/s")
+    if result["errors"]:
+        print("Errors: " + ", ".join(f"{error} x{count}" for error, count in result["errors"].items()))
+    if result["incomplete_results"]:
+        print(f"{result['incomplete_results']} queries finished with missing fragments")
+    print("Latency   " + "  ".join(f"{p} {seconds(v)}" for p, v in result["latency"].items()))
+    print(f"{'Stage':<24}{'mean':>10}{'p95':>10}{'queries':>9}")
+    for name, stage in result["stages"].items():
+        print(f"{name:<24}{seconds(stage['mean']):>10}{seconds(stage['p95']):>10}{stage['queries']:>9}")
+    print("Nodes     " + ", ".join(f"{node.nid} {node.stats()}" for node in nodes))
+    print(f"E-utilities {eutils.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--distinct", type=int, help="distinct sequences, repeated across requests "
+                                                     "(default: one per request)")
+    parser.add_argument("--sequence-length", type=int, default=1000)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nodes", type=int, default=4)
+    parser.add_argument("--fragments", type=int, default=4)
+    parser.add_argument("--replicas", type=int, default=2)
+    parser.add_argument("--latency", default="lognormal:1,0.5",
+                        help="fake node latency: fixed:S, uniform:A,B or lognormal:MEDIAN,SIGMA seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--busy-rate", type=float, default=0.0)
+    parser.add_argument("--eutils-delay", type=float, default=0.05)
+    parser.add_argument("--recordings", help="directory of recorded E-utilities payloads to replay")
+    parser.add_argument("--comm", help="URL of a running communication server using the stand-ins")
+    parser.add_argument("--plugin", help="URL of a running plugin server using --comm")
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--query-timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="file to write the report to")
+    parser.add_argument("--fail-above-p95", type=float, help="exit with status 1 if p95 latency is higher")
+    args = parser.parse_args()
+    if bool(args.comm) != bool(args.plugin):
+        parser.error("--comm and --plugin are given together")
+
+    rng = random.Random(args.seed)
+    sequences = ["".join(rng.choice("ACGT") for _ in range(args.sequence_length))
+                 for _ in range(args.distinct or args.requests)]
+    synbiohub = SynBioHubStub(sequences)
+    nodes, shard_map = start_nodes(args)
+    eutils = StubEutils(0, recordings=args.recordings, delay=args.eutils_delay, host=HOST).start()
+
+    workdir = None
+    processes = []
+    comm_url, plugin_url = args.comm, args.plugin
+    try:
+        if comm_url is None:
+            workdir = tempfile.mkdtemp(prefix="genbanklink_bench_")
+            processes, comm_url, plugin_url = launch_servers(workdir, shard_map, eutils.url)
+        else:
+            print("Running servers must use this shard map and COMM_EUTILS_URL=" + eutils.url)
+            print(json.dumps(shard_map))
+        comm_url, plugin_url = comm_url.rstrip("/") + "/", plugin_url.rstrip("/") + "/"
+
+        parts = [i % len(sequences) for i in range(args.requests)]
+        start = time.monotonic()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            results = list(pool.map(lambda part: run_query(args, synbiohub, comm_url, plugin_url, part), parts))
+        elapsed = time.monotonic() - start
+        for result in results:
+            if "latency" in result:
+                result["stages"].update(traced_stages(comm_url, result["qid"]))
+
+        summary = report(args, results, elapsed)
+        print_report(summary, nodes, eutils)
+        if args.json:
+            with open(args.json, "w") as f:
+                f.write(json.dumps(summary, indent=2))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        for node in nodes:
+            node.stop()
+        eutils.stop()
+        if workdir is not None:
+            print(f"Server logs kept in {workdir}")
+
+    p95 = summary["latency"]["p95"]
+    if args.fail_above_p95 is not None and (p95 is None or p95 > args.fail_above_p95):
+        print(f"p95 latency {p95} is above {args.fail_above_p95}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+"""Stand-in for the NCBI E-utilities, so benchmarks run offline.
+
+Serves elink.fcgi, esummary.fcgi and efetch.fcgi. A request is answered with
+the payload recorded for it, if the recordings directory has one, otherwise
+with a synthetic payload built from the requested ids: every SYN accession the
+fake database nodes report gets a GenBank summary and record, two thirds of
+them link to PubMed articles, which get summaries too, and the rest go through
+the full GenBank file path. An optional delay per call simulates NCBI latency.
+
+Recordings are made by proxying to the real E-utilities once, with network:
+    python benchmarks/stub_eutils.py --port 9100 --recordings benchmarks/recordings \\
+        --record https://eutils.ncbi.nlm.nih.gov/entrez/eutils/
+and replayed offline by leaving out --record. Point the communication server
+at the stub with COMM_EUTILS_URL=http://127.0.0.1:9100/.
+"""
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlparse
+from xml.sax.saxutils import escape
+
+# Parameters that identify the caller rather than the request, left out of recording keys
+CALLER_PARAMS = {"api_key", "email", "tool"}
+
+ESUMMARY_HEADER = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+                   '<!DOCTYPE eSummaryResult PUBLIC "-//NLM//DTD esummary v1 20041029//EN" '
+                   '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20041029/esummary-v1.dtd">\n')
+ELINK_HEADER = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+                '<!DOCTYPE eLinkResult PUBLIC "-//NLM//DTD elink 20101123//EN" '
+                '"https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20101123/elink.dtd">\n')
+
+
+def request_key(util, params):
+    # Key of a request in the recordings, independent of parameter order
+    return util + "?" + urlencode(sorted((k, v) for k, v in params if k not in CALLER_PARAMS))
+
+
+def accession_number(accession_id):
+    # Returns the number of a synthetic accession, with or without version, or None
+    accession_id = accession_id.split(".")[0]
+    if accession_id.startswith("SYN") and accession_id[3:].isdigit():
+        return int(accession_id[3:])
+    return None
+
+
+def pubmed_links(n):
+    # PubMed articles linked to synthetic accession n, none for every third one
+    if n % 3 == 0:
+        return []
+    return [str(30000000 + 2 * n + i) for i in range(1 + n % 2)]
+
+
+def item(name, type, value):
+    return f'\t<Item Name="{name}" Type="{type}">{escape(str(value))}</Item>\n'
+
+
+def elink(ids):
+    # One LinkSet per id, in order, as the server expects
+    sets = []
+    for accession_id in ids:
+        n = accession_number(accession_id)
+        links = pubmed_links(n) if n is not None else []
+        link_set_db = ""
+        if links:
+            link_set_db = ("<LinkSetDb><DbTo>pubmed</DbTo><LinkName>nuccore_pubmed</LinkName>"
+                           + "".join(f"<Link><Id>{pmid}</Id></Link>" for pmid in links) + "</LinkSetDb>")
+        sets.append(f"<LinkSet><DbFrom>nuccore</DbFrom><IdList><Id>{escape(accession_id)}</Id></IdList>"
+                    f"{link_set_db}</LinkSet>")
+    return ELINK_HEADER + "<eLinkResult>" + "".join(sets) + "</eLinkResult>\n"
+
+
+def esummary(db, ids):
+    docs = []
+    for id in ids:
+        if db == "pubmed" and id.isdigit():
+            docs.append(f"<DocSum>\n\t<Id>{id}</Id>\n"
+                        + item("PubDate", "Date", "2021 Jan 1")
+                        + '\t<Item Name="AuthorList" Type="List">\n'
+                        + "".join(item("Author", "String", author) for author in ("Doe J", "Roe R"))
+                        + "\t</Item>\n"
+                        + item("LastAuthor", "String", "Roe R")
+                        + item("Title", "String", f"Synthetic article {id}.")
+                        + item("FullJournalName", "String", "Journal of synthetic biology")
+                        + item("DOI", "String", f"10.0000/syn.{id}")
+                        + item("PmcRefCount", "Integer", int(id) % 50)
+                        + "</DocSum>\n")
+        elif db == "nuccore" and accession_number(id) is not None:
+            n = accession_number(id)
+            docs.append(f"<DocSum>\n\t<Id>{100000 + n}</Id>\n"
+                        + item("Caption", "String", f"SYN{n:06d}")
+                        + item("Title", "String", f"Synthetic construct {n}, complete sequence")
+                        + item("AccessionVersion", "String", f"SYN{n:06d}.1")
+                        + item("Length", "Integer", 1000 + n % 9000)
+                        + "</DocSum>\n")
+    return ESUMMARY_HEADER + "<eSummaryResult>\n" + "".join(docs) + "</eSummaryResult>\n"
+
+
+def genbank_record(n):
+    # GenBank flat file header of synthetic accession n, with a short sequence
+    length = 1000 + n % 9000
+    lines = [f"LOCUS       SYN{n:06d}               {length} bp    DNA     linear   SYN 01-JAN-2021",
+             f"DEFINITION  Synthetic construct {n}, complete sequence.",
+             f"ACCESSION   SYN{n:06d}",
+             f"VERSION     SYN{n:06d}.1",
+             "SOURCE      synthetic construct",
+             "  ORGANISM  synthetic construct",
+             f"REFERENCE   1  (bases 1 to {length})",
+             "  AUTHORS   Doe,J. and Roe,R.",
+             f"  TITLE     Direct Submission of construct {n}",
+             "  JOURNAL   Submitted (01-JAN-2021) Synthetic Biology Lab",
+             "FEATURES             Location/Qualifiers",
+             f"     source          1..{length}",
+             "ORIGIN      ",
+             "        1 acgtacgtac gtacgtacgt acgtacgtac gtacgtacgt acgtacgtac gtacgtacgt",
+             "//"]
+    return "\n".join(lines) + "\n"
+
+
+def efetch(db, ids):
+    numbers = [accession_number(id) for id in ids] if db == "nuccore" else []
+    return "".join(genbank_record(n) for n in numbers if n is not None)
+
+
+class StubEutils:
+    # This class serves the stub E-utilities on its own thread
+    def __init__(self, port, recordings=None, record=None, delay=0.0, host="127.0.0.1"):
+        # Directory of recorded payloads, and the E-utilities URL to record from
+        self.recordings = recordings
+        self.record = record
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.replayed = 0
+        if recordings:
+            os.makedirs(recordings, exist_ok=True)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "replayed": self.replayed}
+
+    def _recording_path(self, key):
+        return os.path.join(self.recordings, hashlib.md5(key.encode()).hexdigest() + ".body")
+
+    def _index(self, key):
+        # Keeps a readable index of the recorded requests next to the payloads
+        path = os.path.join(self.recordings, "index.json")
+        with self.lock:
+            index = {}
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    index = json.loads(f.read())
+            index[os.path.basename(self._recording_path(key))] = key
+            with open(path, "w") as f:
+                f.write(json.dumps(index, indent=1, sort_keys=True))
+
+    def answer(self, util, params):
+        # Returns the payload for a request: recorded, fetched and recorded, or synthetic
+        key = request_key(util, params)
+        with self.lock:
+            self.calls[util] = self.calls.get(util, 0) + 1
+        if self.recordings:
+            path = self._recording_path(key)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    with self.lock:
+                        self.replayed += 1
+                    return f.read()
+            if self.record:
+                with urllib.request.urlopen(self.record + util + "?" + urlencode(params), timeout=60) as response:
+                    body = response.read()
+                with open(path, "wb") as f:
+                    f.write(body)
+                self._index(key)
+                return body
+        time.sleep(self.delay)
+        values = {}
+        for name, value in params:
+            values.setdefault(name, []).append(value)
+        db = values.get("db", [""])[0]
+        ids = [id for value in values.get("id", []) for id in value.split(",") if id]
+        if util == "elink.fcgi":
+            return elink(ids).encode()
+        if util == "esummary.fcgi":
+            return esummary(db, ids).encode()
+        if util == "efetch.fcgi":
+            return efetch(db, ids).encode()
+        return None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def respond(self, params):
+                url = urlparse(self.path)
+                body = stub.answer(url.path.strip("/").rsplit("/", 1)[-1], parse_qsl(url.query) + params)
+                code = 200
+                if body is None:
+                    code, body = 404, b"Unknown E-utility"
+                self.send_response(code)
+                self.send_header("Content-Type", "text/xml" if body.startswith(b"<") else "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond([])
+
+            def do_POST(self):
+                # E-utilities also take their parameters as a form body
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                self.respond(parse_qsl(body))
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--recordings", help="directory of recorded payloads")
+    parser.add_argument("--record", help="E-utilities URL to record missing payloads from")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds added to synthetic answers")
+    args = parser.parse_args()
+    if args.record and not args.recordings:
+        parser.error("--record needs --recordings")
+    stub = StubEutils(args.port, args.recordings, args.record, args.delay, host=args.host).start()
+    print(f"Stub E-utilities serving on {stub.url}")
+    try:
+        stub.thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()